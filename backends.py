@@ -0,0 +1,101 @@
+from importlib.util import find_spec
+from gridworld import Gridworld, State
+import numpy as np
+import math
+
+
+class Backend:
+    # How a solver runs its backups: tile by tile in Python (arrays=False), or as array sweeps over
+    # the compiled CSR table (arrays=True), through kernel() where it returns a faster expectation
+    # than Transitions.expect. requires names the optional module the backend imports.
+    def __init__(self, name, arrays, requires=None, kernel=None) -> None:
+        self.name = name
+        self.arrays = arrays
+        self.requires = requires
+        self._kernel = kernel
+
+    def available(self):
+        return self.requires is None or find_spec(self.requires) is not None
+
+    def kernel(self):
+        return None if self._kernel is None else self._kernel()
+
+
+BACKENDS = {}
+
+
+def register(backend: Backend):
+    BACKENDS[backend.name] = backend
+    return backend
+
+
+def available():
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+PYTHON_BACKUPS = 1e3  # below this much work the tile loop beats the cost of setting up arrays
+JIT_BACKUPS = 1e8  # above it a JIT kernel repays its compile time (about a second)
+
+
+def estimate_backups(model: Gridworld, theta=0.0001):
+    # state-action backups of a value iteration solve, sweeps from the discount and theta
+    states = int(np.count_nonzero(model.codes == State.WALKABLE.value))
+    actions = 4 if getattr(model, "dynamics", None) is None else model.dynamics.actions
+    gamma = model.discount
+    if 0 < gamma < 1:
+        sweeps = max(math.log(theta * (1 - gamma)) / math.log(gamma), 1)
+    else:
+        sweeps = model.rows + model.cols
+    return states * actions * sweeps
+
+
+def select(model: Gridworld, theta=0.0001):
+    work = estimate_backups(model, theta)
+    if work < PYTHON_BACKUPS:
+        return "python"
+    if work > JIT_BACKUPS and BACKENDS["numba"].available():
+        return "numba"
+    return "numpy"
+
+
+def resolve(name, model: Gridworld, theta=0.0001):
+    # the Backend for name, "auto" picks one from the size of the solve
+    if name == "auto":
+        name = select(model, theta)
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise Exception("Unsupported Backend")
+    if not backend.available():
+        raise Exception(f"The {name} backend requires {backend.requires}")
+    return backend
+
+
+_numba_expect = None
+
+
+def numba_kernel():
+    # one fused gather-multiply-add per CSR row, rows spread over every core; compiled once per process
+    global _numba_expect
+    if _numba_expect is None:
+        import numba
+
+        @numba.njit(parallel=True)
+        def rows_expect(indptr, indices, probs, util, out):
+            for row in numba.prange(len(out)):
+                total = 0.0
+                for k in range(indptr[row], indptr[row + 1]):
+                    total += probs[k] * util[indices[k]]
+                out[row] = total
+
+        def expect(block, util):
+            out = np.empty(len(block))
+            rows_expect(block.indptr, block.indices, block.probs, np.asarray(util, dtype=np.float64), out)
+            return out
+
+        _numba_expect = expect
+    return _numba_expect
+
+
+register(Backend("python", arrays=False))
+register(Backend("numpy", arrays=True))
+register(Backend("numba", arrays=True, requires="numba", kernel=numba_kernel))
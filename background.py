@@ -0,0 +1,167 @@
+from gridworld import Gridworld, DisplayMode
+import threading
+
+
+class SolveCancelled(Exception):
+    pass
+
+
+class Snapshot:
+    # read-only copy of a solver's progress, safe to hand across threads
+    __slots__ = ("util", "dir", "q", "event")
+
+    def __init__(self, model: Gridworld, event) -> None:
+        self.util = model.util.copy()
+        self.dir = model.dir.copy()
+        self.q = model.q.copy()
+        self.event = event
+        for array in (self.util, self.dir, self.q):
+            array.flags.writeable = False
+
+    def apply(self, model: Gridworld):
+        model.util[:] = self.util
+        model.dir[:] = self.dir
+        model.set_actions(len(self.q))
+        model.q[:] = self.q
+
+
+class BackgroundSolve:
+    # Runs make_solver(copy of model) on a worker thread at full speed. The UI calls request()
+    # and sync(model) once per frame; the worker only copies its arrays when a frame asked for them.
+    def __init__(self, model: Gridworld, make_solver, **call_kwargs) -> None:
+        self.work = model.copy()
+        self.solver = make_solver(self.work)
+        self.solver.subscribe(self)
+        self.call_kwargs = dict(call_kwargs, display_result=False)
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.wanted = False
+        self.snapshot = None
+        self.version = 0
+        self.seen = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def needs_model(self):
+        # array backends only write back to self.work when a snapshot is pending
+        return self.wanted
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.solver(**self.call_kwargs)
+        except SolveCancelled:
+            return
+        except Exception as error:
+            self.error = error
+            return
+        self._publish(None)
+
+    def _publish(self, event):
+        snapshot = Snapshot(self.work, event)
+        with self.lock:
+            self.snapshot = snapshot
+            self.version += 1
+            self.wanted = False
+
+    def __call__(self, event):
+        if self.cancelled.is_set():
+            raise SolveCancelled()
+        if self.wanted:
+            self._publish(event)
+
+    def request(self):
+        self.wanted = True
+
+    def sync(self, model: Gridworld):
+        # copies the newest snapshot into model, True if there was one the UI had not seen
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            snapshot, version = self.snapshot, self.version
+        if snapshot is None or version == self.seen:
+            return False
+        snapshot.apply(model)
+        self.seen = version
+        return True
+
+    def cancel(self):
+        self.cancelled.set()
+        self.thread.join()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def done(self):
+        return not self.running() and self.seen == self.version
+
+
+def run_window(grid: Gridworld, new_grid=None, fps=30, cache=None, theta=0.0001):
+    # V/P + 1/2 solve in the background, W wipes, N asks new_grid() for a new map, ESC quits.
+    # Solutions go into cache, so solving an unchanged map again is instant and a changed MDP
+    # starts from the closest cached values and policy.
+    from optimalPolicy import ValueIteration, PolicyIteration
+    from cache import SolutionCache
+    import pygame as pg
+    mode = DisplayMode.UTILxDIR
+    grid.display(mode)
+    clock = pg.time.Clock()
+    cache = SolutionCache() if cache is None else cache
+    solve = nearest = None
+
+    running = True
+    while running:
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                running = False
+
+            if grid.renderer.handle(event):
+                grid.display(mode)
+
+            if event.type == pg.KEYDOWN:
+                if event.key == pg.K_ESCAPE:
+                    running = False
+
+                if event.key == pg.K_w:
+                    if solve is not None:
+                        solve.cancel()
+                        solve = None
+                    grid.wipe()
+                    grid.display(mode)
+
+                if event.key == pg.K_n and new_grid is not None:
+                    if solve is not None:
+                        solve.cancel()
+                        solve = None
+                    grid = new_grid()
+                    grid.display(mode)
+
+        pressed = pg.key.get_pressed()
+        if solve is None and (pressed[pg.K_v] or pressed[pg.K_p]) and (pressed[pg.K_1] or pressed[pg.K_2]):
+            mode = DisplayMode.UTILxDIR if pressed[pg.K_1] else DisplayMode.QVAL
+            result, nearest = cache.prepare(grid, theta)
+            if result == "hit":
+                grid.display(mode)
+            elif pressed[pg.K_v]:
+                solve = BackgroundSolve(grid, ValueIteration, theta=theta).start()
+            else:
+                solve = BackgroundSolve(grid, lambda model: PolicyIteration(model, {}), theta=theta).start()
+
+        if solve is not None:
+            if solve.sync(grid):
+                grid.display(mode)
+            if solve.done():
+                if solve.error is None:
+                    cache.store(solve.work, theta, solve.solver, nearest)
+                solve = None
+            else:
+                solve.request()
+
+        clock.tick(fps)
+
+    if solve is not None:
+        solve.cancel()
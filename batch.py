@@ -0,0 +1,72 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product, repeat
+from gridworld import Gridworld
+from optimalPolicy import ValueIteration, PolicyIteration
+
+
+SOLVERS = ("value", "policy")
+
+_worker_map = None
+
+
+def parameter_grid(discounts=(.9,), noises=(.2,), living_rewards=(0,)):
+    return [{"discount": discount, "noise": noise, "living_reward": reward}
+            for discount, noise, reward in product(discounts, noises, living_rewards)]
+
+
+def _init_worker(codes, rows, cols, dynamics=None):
+    # every worker receives the map once instead of once per setting
+    global _worker_map
+    _worker_map = (codes, rows, cols, dynamics)
+
+
+def _solve_setting(setting, solver, theta, max_iter, solver_kwargs):
+    codes, rows, cols, dynamics = _worker_map
+    model = Gridworld(rows, cols, codes=codes)
+    model.dynamics = dynamics
+    model.discount = setting["discount"]
+    model.noise = setting["noise"]
+    model.living_reward = setting["living_reward"]
+
+    if solver == "value":
+        mdp_solver = ValueIteration(model, **solver_kwargs)
+        mdp_solver(theta=theta, display_result=False)
+    else:
+        # load_codes leaves every tile pointing up, so an empty pi starts from the usual all-"U" policy
+        mdp_solver = PolicyIteration(model, {}, **solver_kwargs)
+        mdp_solver(theta=theta, display_result=False, max_iter=max_iter)
+
+    return dict(setting, util=model.util.copy(), policy=model.dir.copy(),
+                iterations=mdp_solver.iterations, runtime=mdp_solver.runtime)
+
+
+def solve_parameter_grid(model: Gridworld, settings, solver="value", theta=0.0001, max_iter=15,
+                         workers=None, **solver_kwargs):
+    # solves one map under every (discount, noise, living_reward) setting, one row per setting
+    if solver not in SOLVERS:
+        raise Exception("Unsupported Solver")
+    solver_kwargs.setdefault("backend", "numpy")
+    settings = list(settings)
+    initargs = (model.codes.copy(), model.rows, model.cols, model.dynamics)
+
+    if workers == 1:
+        _init_worker(*initargs)
+        results = [_solve_setting(setting, solver, theta, max_iter, solver_kwargs) for setting in settings]
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.map(_solve_setting, settings, repeat(solver), repeat(theta),
+                                    repeat(max_iter), repeat(solver_kwargs)))
+
+    # settings that end up with the same policy share a policy_id
+    policies = {}
+    for row in results:
+        row["policy_id"] = policies.setdefault(row["policy"].tobytes(), len(policies))
+    return results
+
+
+def policy_groups(results):
+    groups = {}
+    for row in results:
+        setting = (row["discount"], row["noise"], row["living_reward"])
+        groups.setdefault(row["policy_id"], []).append(setting)
+    return groups
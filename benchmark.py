@@ -0,0 +1,194 @@
+from concurrent.futures import ProcessPoolExecutor
+from gridworld import Gridworld
+from optimalPolicy import ValueIteration, PolicyIteration
+from parallel import ParallelValueIteration
+from backends import BACKENDS
+import argparse
+import math
+import os
+import json
+import platform
+import random
+import resource
+import sys
+
+
+SIZES = (10, 32, 100, 316, 1000)  # 10^2 to 10^6 cells
+QUICK_SIZES = (10, 32, 100)
+RATIOS = ((10, 20), (2, 35))  # (goal_ratio, wall_ratio)
+MODES = {
+    "value": ({"backend": "python"},
+              {"backend": "numpy"},
+              {"backend": "numba"},
+              {"backend": "auto"},
+              {"backend": "numpy", "sweep": "gauss-seidel"},
+              {"backend": "numpy", "sweep": "ordered"},
+              {"backend": "numpy", "multigrid": True},
+              {"backend": "numpy", "stopping": "span"},
+              {"backend": "numpy", "stopping": "epsilon", "eliminate": True}),
+    "policy": ({"backend": "python"},
+               {"backend": "numpy"},
+               {"backend": "numpy", "evaluation": "modified", "sweeps": 10},
+               {"backend": "numpy", "evaluation": "exact"}),
+}
+PYTHON_LIMIT = 2500  # cells, the pure-Python backend is skipped on larger maps
+SCALING_SIZES = (316, 1000)
+
+
+def case_key(case):
+    mode = ",".join(f"{key}={value}" for key, value in case["mode"].items())
+    size = case["size"]
+    return f"{case['solver']}/{mode}/{size}x{size}/goal{case['goal_ratio']}-wall{case['wall_ratio']}"
+
+
+def make_cases(sizes, ratios, solvers):
+    for size in sizes:
+        for goal_ratio, wall_ratio in ratios:
+            for solver in solvers:
+                for mode in MODES[solver]:
+                    if mode["backend"] == "python" and size * size > PYTHON_LIMIT:
+                        continue
+                    if mode["backend"] != "auto" and not BACKENDS[mode["backend"]].available():
+                        continue
+                    yield {"solver": solver, "mode": mode, "size": size,
+                           "goal_ratio": goal_ratio, "wall_ratio": wall_ratio}
+
+
+def make_map(size, goal_ratio, wall_ratio, seed):
+    random.seed(seed)
+    return Gridworld(size, size, True, goal_ratio, wall_ratio).codes
+
+
+def run_case(case, codes, theta, repeat):
+    # runs in a fresh worker process so the peak RSS belongs to this case alone
+    model = Gridworld(case["size"], case["size"], codes=codes)
+    best = None
+    for _ in range(repeat):
+        model.wipe()
+        if case["solver"] == "value":
+            solver = ValueIteration(model, **case["mode"])
+        else:
+            solver = PolicyIteration(model, {}, **case["mode"])
+        solver(theta=theta, display_result=False)
+        if best is None or solver.runtime < best.runtime:
+            best = solver
+
+    return dict(case, key=case_key(case), seconds=best.runtime, iterations=best.iterations,
+                backups=best.backups, backups_per_second=best.backups / max(best.runtime, 1e-12),
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def run_suite(sizes=SIZES, ratios=RATIOS, solvers=("value", "policy"), theta=0.0001, repeat=3, seed=0):
+    maps, results = {}, []
+    for case in make_cases(sizes, ratios, solvers):
+        layout = (case["size"], case["goal_ratio"], case["wall_ratio"])
+        if layout not in maps:
+            maps[layout] = make_map(*layout, seed)
+
+        with ProcessPoolExecutor(1) as pool:
+            result = pool.submit(run_case, case, maps[layout], theta, repeat).result()
+        print(f"{result['key']}: {result['seconds']:.4f}s, {result['iterations']} iterations,",
+              f"{result['backups_per_second']:.3g} backups/s, {result['peak_rss_mb']:.1f} MiB", flush=True)
+        results.append(result)
+    return results
+
+
+def run_parallel(size, codes, workers, theta, repeat):
+    model = Gridworld(size, size, codes=codes)
+    best = None
+    for _ in range(repeat):
+        model.wipe()
+        solver = ValueIteration(model, backend="numpy") if workers == 0 else ParallelValueIteration(model, workers)
+        solver(theta=theta, display_result=False)
+        if best is None or solver.runtime < best.runtime:
+            best = solver
+    return {"seconds": best.runtime, "iterations": best.iterations}
+
+
+def run_scaling(sizes=SCALING_SIZES, workers=(1, 2, 4, 8), theta=0.0001, repeat=3, seed=0):
+    # Strong scaling solves one size x size map with every worker count, weak scaling grows the map
+    # with the worker count so every worker keeps size^2 cells. Sweep counts differ between maps, so
+    # efficiency compares seconds per sweep against one worker; speedup is against the serial solver.
+    results = []
+    for size in sizes:
+        for kind in ("strong", "weak"):
+            single = None
+            for count in workers:
+                side = size if kind == "strong" else round(size * math.sqrt(count))
+                codes = make_map(side, *RATIOS[0], seed)
+                with ProcessPoolExecutor(1) as pool:
+                    serial = pool.submit(run_parallel, side, codes, 0, theta, repeat).result()
+                    result = pool.submit(run_parallel, side, codes, count, theta, repeat).result()
+                per_sweep = result["seconds"] / result["iterations"]
+                single = per_sweep if single is None else single
+                ideal = single / count if kind == "strong" else single
+                row = dict(result, kind=kind, size=size, side=side, workers=count,
+                           serial_seconds=serial["seconds"], speedup=serial["seconds"] / result["seconds"],
+                           efficiency=ideal / per_sweep)
+                print(f"{kind} {side}x{side}, {count} workers: {result['seconds']:.4f}s,",
+                      f"{row['speedup']:.2f}x serial, {row['efficiency']:.0%} efficiency", flush=True)
+                results.append(row)
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    # cases that got slower than the baseline by more than tolerance, ignoring timings too short to trust
+    previous = {result["key"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result["key"])
+        if old is None or old["seconds"] < min_seconds:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append((result["key"], old["seconds"], result["seconds"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmark suite for the gridworld MDP solvers")
+    parser.add_argument("--quick", action="store_true", help=f"only run sizes {QUICK_SIZES}")
+    parser.add_argument("--sizes", type=int, nargs="+", help="grid side lengths to run")
+    parser.add_argument("--solvers", nargs="+", default=["value", "policy"], choices=list(MODES))
+    parser.add_argument("--theta", type=float, default=0.0001)
+    parser.add_argument("--repeat", type=int, default=3, help="solves per case, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="baseline timings below this are too noisy to compare")
+    parser.add_argument("--scaling", action="store_true",
+                        help="run the strong/weak scaling benchmark of the parallel solver instead")
+    parser.add_argument("--workers", type=int, nargs="+", help="worker counts for --scaling")
+    args = parser.parse_args(argv)
+
+    if args.scaling:
+        workers = args.workers or [count for count in (1, 2, 4, 8, 16, 32) if count <= (os.cpu_count() or 1)]
+        results = run_scaling(args.sizes or SCALING_SIZES, workers, args.theta, args.repeat, args.seed)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                           "cpus": os.cpu_count(), "theta": args.theta, "seed": args.seed,
+                           "scaling": results}, file, indent=2)
+        return
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    results = run_suite(sizes, RATIOS, args.solvers, args.theta, args.repeat, args.seed)
+    report = {"python": platform.python_version(), "machine": platform.machine(),
+              "theta": args.theta, "seed": args.seed, "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance, args.min_seconds)
+        for key, old, new, ratio in regressions:
+            print(f"REGRESSION {key}: {old:.4f}s -> {new:.4f}s ({ratio:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmark case(s) slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from gridworld import Gridworld
+import hashlib
+import numpy as np
+import os
+
+
+def layout_key(model: Gridworld):
+    # content hash of the map and its dynamics, any change to a wall or terminal gives a new key
+    digest = hashlib.sha1(f"{model.rows}x{model.cols}".encode())
+    digest.update(np.ascontiguousarray(model.codes).tobytes())
+    if getattr(model, "dynamics", None) is not None:
+        digest.update(model.dynamics.key().encode())
+    return digest.hexdigest()
+
+
+def params_of(model: Gridworld, theta):
+    return (float(model.discount), float(model.noise), float(model.living_reward), float(theta))
+
+
+class Solution:
+    __slots__ = ("layout", "params", "util", "dir", "q", "iterations", "backups")
+
+    def __init__(self, layout, params, util, dir, q, iterations=0, backups=0) -> None:
+        self.layout = layout
+        self.params = params
+        self.util = util
+        self.dir = dir
+        self.q = q
+        self.iterations = iterations
+        self.backups = backups
+
+    @classmethod
+    def of(cls, model: Gridworld, theta, solver=None):
+        return cls(layout_key(model), params_of(model, theta), model.util.copy(), model.dir.copy(),
+                   model.q.copy(), getattr(solver, "iterations", 0), getattr(solver, "backups", 0))
+
+    def apply(self, model: Gridworld, q=True):
+        model.util[:] = self.util
+        model.dir[:] = self.dir
+        if q:
+            model.set_actions(len(self.q))
+            model.q[:] = self.q
+
+    def answers(self, params):
+        # same MDP, solved at least as tightly as asked for
+        return self.params[:3] == params[:3] and self.params[3] <= params[3]
+
+    def distance(self, params):
+        return sum(abs(a - b) for a, b in zip(self.params[:3], params[:3]))
+
+    def path(self, directory):
+        digest = hashlib.sha1(repr(self.params).encode()).hexdigest()[:16]
+        return os.path.join(directory, f"{self.layout}-{digest}.npz")
+
+    def save(self, directory):
+        np.savez(self.path(directory), params=np.array(self.params), util=self.util, dir=self.dir,
+                 q=self.q, counts=np.array([self.iterations, self.backups]))
+
+    @classmethod
+    def load(cls, layout, path):
+        with np.load(path) as data:
+            iterations, backups = data["counts"].tolist()
+            return cls(layout, tuple(data["params"].tolist()), data["util"], data["dir"], data["q"],
+                       iterations, backups)
+
+
+class SolutionCache:
+    # Solutions keyed by layout hash and (discount, noise, living_reward, theta). Recently used ones
+    # stay in memory, the least recently used is evicted past maxsize; with a directory every
+    # solution is also written to disk and found again by later runs.
+    def __init__(self, maxsize=64, directory=None) -> None:
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.warm_starts = 0
+        self.misses = 0
+        self.backups_saved = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remember(self, solution: Solution):
+        key = (solution.layout, solution.params)
+        self.entries[key] = solution
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _candidates(self, layout):
+        for (entry_layout, _), solution in reversed(self.entries.items()):
+            if entry_layout == layout:
+                yield solution
+
+    def _disk_candidates(self, layout):
+        if self.directory is None:
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(layout + "-") and name.endswith(".npz"):
+                yield Solution.load(layout, os.path.join(self.directory, name))
+
+    def put(self, model: Gridworld, theta=0.0001, solver=None):
+        solution = Solution.of(model, theta, solver)
+        self._remember(solution)
+        if self.directory is not None:
+            solution.save(self.directory)
+        return solution
+
+    def get(self, model: Gridworld, theta=0.0001):
+        # exact hit, from memory first and then from disk, or None
+        layout, params = layout_key(model), params_of(model, theta)
+        for solution in self._candidates(layout):
+            if solution.answers(params):
+                self.entries.move_to_end((solution.layout, solution.params))
+                return solution
+        for solution in self._disk_candidates(layout):
+            if solution.answers(params):
+                self.disk_hits += 1
+                self._remember(solution)
+                return solution
+        return None
+
+    def nearest(self, model: Gridworld, theta=0.0001):
+        # the cached solution of the same layout with the closest discount, noise and living reward
+        layout, params = layout_key(model), params_of(model, theta)
+        candidates = list(self._candidates(layout))
+        if not candidates:
+            candidates = list(self._disk_candidates(layout))
+        return min(candidates, key=lambda solution: solution.distance(params), default=None)
+
+    def prepare(self, model: Gridworld, theta=0.0001):
+        # Loads model with the best starting point: "hit" means it already holds the solution,
+        # "warm" that it holds the closest cached values and policy, "cold" that it was wiped.
+        solution = self.get(model, theta)
+        if solution is not None:
+            self.hits += 1
+            self.backups_saved += solution.backups
+            solution.apply(model)
+            return "hit", solution
+
+        self.misses += 1
+        solution = self.nearest(model, theta)
+        model.wipe()
+        if solution is None:
+            return "cold", None
+        self.warm_starts += 1
+        solution.apply(model, q=False)
+        return "warm", solution
+
+    def solve(self, model: Gridworld, make_solver, theta=0.0001, **call_kwargs):
+        # returns the solver that ran, or None when the cache already had the answer
+        result, nearest = self.prepare(model, theta)
+        if result == "hit":
+            return None
+        solver = make_solver(model)
+        solver(theta=theta, **call_kwargs)
+        self.store(model, theta, solver, nearest)
+        return solver
+
+    def store(self, model: Gridworld, theta, solver, nearest=None):
+        # after a warm start, the neighbour's own solve cost stands in for a cold one
+        if nearest is not None:
+            self.backups_saved += max(nearest.backups - solver.backups, 0)
+        return self.put(model, theta, solver)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "warm_starts": self.warm_starts,
+                "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "backups_saved": self.backups_saved, "entries": len(self.entries)}
@@ -0,0 +1,232 @@
+import numpy as np
+from gridworld import Gridworld, State
+from dynamics import Slip
+
+
+def gather(indptr, rows):
+    # entry positions of the given CSR rows, concatenated in order, and the new indptr
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=new_indptr[1:])
+    entries = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return entries, new_indptr
+
+
+class Transitions:
+    # CSR rows of (state, action) pairs: row r moves to indices[indptr[r]:indptr[r+1]] with probs
+    # and rewards of the same slice. reward is the expected reward of every row.
+    __slots__ = ("indptr", "indices", "probs", "rewards", "reward")
+
+    def __init__(self, indptr, indices, probs, rewards) -> None:
+        self.indptr = indptr
+        self.indices = indices
+        self.probs = probs
+        self.rewards = rewards
+        self.reward = np.add.reduceat(probs * rewards, indptr[:-1]) if len(indptr) > 1 else np.zeros(0)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def expect(self, util):
+        # expected utility of the next state for every row
+        if not len(self):
+            return np.zeros(0)
+        return np.add.reduceat(self.probs * util[self.indices], self.indptr[:-1])
+
+    def take(self, rows):
+        entries, indptr = gather(self.indptr, rows)
+        return Transitions(indptr, self.indices[entries], self.probs[entries], self.rewards[entries])
+
+
+class CompiledGrid:
+    # A Gridworld and its dynamics (model.dynamics, the noisy four-way Slip by default) compiled
+    # into one CSR transition table over the walkable states; row a * m + i is action a taken in
+    # states[i]. Every solver backs up through it, so richer dynamics only add transitions.
+    def __init__(self, model: Gridworld, dynamics=None):
+        self.rows, self.cols = model.rows, model.cols
+        self.n = model.rows * model.cols
+        self.noise = model.noise
+        self.discount = model.discount
+        self.living_reward = model.living_reward
+        self.dynamics = getattr(model, "dynamics", None) if dynamics is None else dynamics
+        if self.dynamics is None:
+            self.dynamics = Slip()
+        self.actions = self.dynamics.actions
+        self._read_arrays(model)
+        self._build_transitions(model)
+        self.kernel = None  # expectation over a block's rows in place of Transitions.expect, see backends.py
+        self._blocks = {}
+        self._policy = None
+        self._predecessors = None
+        self._cumulative = None
+
+    def _read_arrays(self, model: Gridworld):
+        self.codes = model.codes.copy()
+        self.util = model.util.copy()
+        self.walls = self.codes == State.WALL.value
+        self.walkable = self.codes == State.WALKABLE.value
+        self.terminal = (self.codes == State.DIAMOND.value) | (self.codes == State.PIT.value)
+        self.states = np.flatnonzero(self.walkable)
+        self.position = np.full(self.n, -1)
+        self.position[self.states] = np.arange(len(self.states))
+
+    def move(self, cells, dr, dc):
+        # one step from every cell, bumping into an edge or a wall (or having ended the episode
+        # on a terminal) leaves the agent in place
+        rows, cols = np.divmod(cells, self.cols)
+        rows, cols = rows + dr, cols + dc
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        target = np.where(inside, rows * self.cols + cols, cells)
+        return np.where(self.walls[target] | self.terminal[cells], cells, target)
+
+    def _build_transitions(self, model: Gridworld):
+        m = len(self.states)
+        outcomes = [[] for _ in range(self.actions)]
+        targets = {}
+        for action, path, prob in self.dynamics.outcomes(model):
+            if path not in targets:
+                cells = self.states
+                for dr, dc in path:
+                    cells = self.move(cells, dr, dc)
+                targets[path] = cells
+            prob = np.asarray(prob, dtype=np.float64)
+            outcomes[action].append((targets[path], prob[self.states] if prob.ndim else np.full(m, prob)))
+
+        counts, indices, probs = [], [], []
+        for action in range(self.actions):
+            # outcomes of a state that land on the same cell are merged, impossible ones dropped
+            nxt = np.array([cells for cells, _ in outcomes[action]]).reshape(len(outcomes[action]), m)
+            prob = np.array([prob for _, prob in outcomes[action]]).reshape(len(outcomes[action]), m)
+            order = np.argsort(nxt, axis=0, kind="stable")
+            nxt, prob = np.take_along_axis(nxt, order, 0), np.take_along_axis(prob, order, 0)
+            for k in range(1, len(nxt)):
+                same = nxt[k] == nxt[k-1]
+                prob[k, same] += prob[k-1, same]
+                prob[k-1, same] = 0
+            keep = (prob > 0).T
+            counts.append(keep.sum(axis=1))
+            indices.append(nxt.T[keep])
+            probs.append(prob.T[keep])
+
+        indptr = np.zeros(self.actions * m + 1, dtype=np.intp)
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+        indices = np.concatenate(indices).astype(np.intp)
+        probs = np.concatenate(probs)
+        self.transitions = Transitions(indptr, indices, probs, np.full(len(probs), float(self.living_reward)))
+
+    def block(self, positions=slice(None)):
+        # the rows of every action for the walkable states at positions, cached per positions array
+        if isinstance(positions, slice) and positions == slice(None):
+            return self.transitions
+        cached = self._blocks.get(id(positions))
+        if cached is None or cached[0] is not positions:
+            m = len(self.states)
+            positions_array = np.arange(m)[positions]
+            rows = (np.arange(self.actions)[:, None] * m + positions_array).ravel()
+            cached = self._blocks[id(positions)] = (positions, self.transitions.take(rows))
+        return cached[1]
+
+    def expect(self, block, util):
+        return block.expect(util) if self.kernel is None else self.kernel(block, util)
+
+    def bellman(self, util, positions=slice(None)):
+        # Q-values of every action for the walkable states at positions, shape (actions, len(positions))
+        block = self.block(positions)
+        return (block.reward + self.discount * self.expect(block, util)).reshape(self.actions, -1)
+
+    def predecessors(self):
+        # reverse CSR over cells: the walkable cells that can move into each cell in one step
+        if self._predecessors is None:
+            t, m = self.transitions, len(self.states)
+            sources = self.states[np.repeat(np.arange(len(t)) % max(m, 1), np.diff(t.indptr))]
+            order = np.argsort(t.indices, kind="stable")
+            indptr = np.zeros(self.n + 1, dtype=np.intp)
+            np.cumsum(np.bincount(t.indices, minlength=self.n), out=indptr[1:])
+            self._predecessors = (indptr, sources[order])
+        return self._predecessors
+
+    def distances(self, sources=None):
+        # breadth-first steps from the nearest source (default: any terminal) over walkable cells,
+        # -1 where no source can be reached
+        indptr, preds = self.predecessors()
+        dist = np.full(self.n, -1)
+        frontier = np.flatnonzero(self.terminal if sources is None else sources)
+        dist[frontier] = 0
+        level = 0
+        while frontier.size:
+            level += 1
+            reached = np.unique(preds[gather(indptr, frontier)[0]])
+            reached = reached[(dist[reached] < 0) & self.walkable[reached]]
+            dist[reached] = level
+            frontier = reached
+        return dist
+
+    def write_back(self, model: Gridworld, util, q):
+        model.set_actions(self.actions)
+        model.util[self.states] = util[self.states]
+        model.q[:, self.states] = q
+        model.dir[self.states] = np.argmax(q, axis=0)
+
+    def sample(self, cells, actions, rand):
+        # next cells of actions taken in walkable cells, rand holds one uniform draw per agent
+        t = self.transitions
+        if self._cumulative is None:
+            # per-row cumulative probabilities offset by the row number, increasing across rows
+            total = np.cumsum(t.probs)
+            starts = total[t.indptr[:-1]] - t.probs[t.indptr[:-1]]
+            rows = np.repeat(np.arange(len(t)), np.diff(t.indptr))
+            self._cumulative = rows + (total - starts[rows])
+        rows = actions * len(self.states) + self.position[cells]
+        entries = np.searchsorted(self._cumulative, rows + rand, side="right")
+        entries = np.clip(entries, t.indptr[rows], t.indptr[rows + 1] - 1)
+        return t.indices[entries]
+
+    def python_rows(self):
+        # the transition table as lists, for the per-tile backend
+        t = self.transitions
+        return (t.indptr.tolist(), t.indices.tolist(), t.probs.tolist(), t.rewards.tolist(),
+                self.position.tolist())
+
+    def policy_block(self, policy):
+        # the row of the policy's action for every walkable state, kept while the policy is unchanged
+        if self._policy is None or not np.array_equal(self._policy[0], policy):
+            m = len(self.states)
+            rows = np.asarray(policy, dtype=np.intp) * m + np.arange(m)
+            self._policy = (np.array(policy, copy=True), self.transitions.take(rows))
+        return self._policy[1]
+
+    def policy_backup(self, util, policy):
+        block = self.policy_block(policy)
+        return block.reward + self.discount * self.expect(block, util)
+
+    def policy_system(self, util, policy):
+        # (I - gamma P_pi) V = R over the walkable states, terminal utilities move into R
+        import scipy.sparse as sp
+        block = self.policy_block(policy)
+        m = len(self.states)
+        rows = np.repeat(np.arange(m), np.diff(block.indptr))
+        weights = self.discount * block.probs
+        position = self.position[block.indices]
+        inner = position >= 0
+        p_pi = sp.csr_matrix((weights[inner], (rows[inner], position[inner])), shape=(m, m))
+        outer = ~inner
+        reward = block.reward + np.bincount(rows[outer], weights[outer] * util[block.indices[outer]], minlength=m)
+        return sp.identity(m, format="csr") - p_pi, reward
+
+    def solve_policy(self, util, policy, method="direct", theta=0.0001):
+        try:
+            import scipy.sparse.linalg as spla
+        except ImportError:
+            raise Exception("Exact policy evaluation requires scipy")
+        a, reward = self.policy_system(util, policy)
+        if method == "direct":
+            return spla.spsolve(a.tocsc(), reward)
+        if method == "gmres":
+            atol = max(theta * (1 - self.discount), 1e-12)
+            values, info = spla.gmres(a, reward, x0=util[self.states], rtol=0, atol=atol)
+            if info != 0:
+                # a partial solve is not an exact evaluation
+                raise Exception("GMRES did not converge, use linear_solver=\"direct\"")
+            return values
+        raise Exception("Unsupported Linear Solver")
@@ -0,0 +1,93 @@
+from collections import deque
+from gridworld import State
+
+
+class WallPlacer:
+    # Adds walls to a flat state-code array while keeping every non-wall cell connected.
+    # A candidate is first checked on its 3x3 neighbourhood, only when its open neighbours
+    # are not joined around it does a search run, and it stops as soon as they meet again
+    # or the smallest cut-off side runs out of cells.
+    def __init__(self, codes, rows, cols) -> None:
+        self.codes = codes
+        self.rows = rows
+        self.cols = cols
+        self.open = bytearray((codes != State.WALL.value).tobytes())
+        self.local_checks = 0
+        self.searches = 0
+
+    def _is_open(self, row, col):
+        return 0 <= row < self.rows and 0 <= col < self.cols and self.open[row * self.cols + col]
+
+    def neighbors(self, index):
+        row, col = divmod(index, self.cols)
+        if row > 0 and self.open[index - self.cols]:
+            yield index - self.cols
+        if col < self.cols - 1 and self.open[index + 1]:
+            yield index + 1
+        if row < self.rows - 1 and self.open[index + self.cols]:
+            yield index + self.cols
+        if col > 0 and self.open[index - 1]:
+            yield index - 1
+
+    def _locally_connected(self, index):
+        row, col = divmod(index, self.cols)
+        orth = [self._is_open(row-1, col), self._is_open(row, col+1),
+                self._is_open(row+1, col), self._is_open(row, col-1)]  # N, E, S, W
+        corners = [self._is_open(row-1, col+1), self._is_open(row+1, col+1),
+                   self._is_open(row+1, col-1), self._is_open(row-1, col-1)]  # NE, SE, SW, NW
+        links = sum(orth[i] and orth[(i+1) % 4] and corners[i] for i in range(4))
+        groups = 1 if links == 4 else sum(orth) - links
+        return groups <= 1
+
+    def _reconnects(self, index):
+        # grow one search per open neighbour in lockstep, merging searches that touch
+        seeds = list(self.neighbors(index))
+        label = {seed: k for k, seed in enumerate(seeds)}
+        parent = list(range(len(seeds)))
+        frontier = {k: deque([seed]) for k, seed in enumerate(seeds)}
+
+        def find(k):
+            while parent[k] != k:
+                k = parent[k]
+            return k
+
+        self.open[index] = 0
+        try:
+            while len(frontier) > 1:
+                for k in list(frontier):
+                    if k not in frontier:
+                        continue
+                    queue = frontier[k]
+                    if not queue:
+                        return False
+                    current = queue.popleft()
+                    for neighbor in self.neighbors(current):
+                        other = label.get(neighbor)
+                        if other is None:
+                            label[neighbor] = k
+                            queue.append(neighbor)
+                            continue
+                        root = find(other)
+                        if root != k:
+                            parent[root] = k
+                            queue.extend(frontier.pop(root))
+            return True
+        finally:
+            self.open[index] = 1
+
+    def can_remove(self, index, search=True):
+        # search=False refuses every cell the 3x3 check cannot clear on its own
+        self.local_checks += 1
+        if self._locally_connected(index):
+            return True
+        if not search:
+            return False
+        self.searches += 1
+        return self._reconnects(index)
+
+    def add_wall(self, index, search=True):
+        if not self.open[index] or not self.can_remove(index, search):
+            return False
+        self.open[index] = 0
+        self.codes[index] = State.WALL.value
+        return True
@@ -0,0 +1,140 @@
+import hashlib
+import numpy as np
+
+
+MOVES4 = ((0, -1), (-1, 0), (0, 1), (1, 0))  # L, U, R, D
+MOVES8 = MOVES4 + ((-1, -1), (-1, 1), (1, 1), (1, -1))  # then UL, UR, DR, DL
+COMPASS8 = (0, 4, 1, 5, 2, 6, 3, 7)  # MOVES8 indices clockwise from L
+
+
+# A dynamics spec lists, for every action, its outcomes as (action, path, probability): path is a
+# tuple of (dr, dc) steps taken one after the other, each one blocked by walls and edges, and the
+# probability is a number or one value per cell. CompiledGrid turns the outcomes into CSR transitions.
+
+
+def spec_value(value, arrays):
+    # a scalar (or None) as itself, per-cell values moved into arrays and referred to by name
+    if value is None or np.ndim(value) == 0:
+        return None if value is None else float(value)
+    name = f"dynamics{len(arrays)}"
+    arrays[name] = np.asarray(value, dtype=np.float64).reshape(-1)
+    return {"array": name}
+
+
+def from_spec(spec, arrays):
+    # rebuilds the dynamics described by spec(), arrays maps the names it refers to back to values
+    def value(param):
+        return arrays[param["array"]] if isinstance(param, dict) else param
+
+    if spec is None:
+        return None
+    if spec["kind"] in ("Slip", "KingMoves"):
+        return (Slip if spec["kind"] == "Slip" else KingMoves)(value(spec["noise"]))
+    if spec["kind"] == "Wind":
+        return Wind(from_spec(spec["base"], arrays), spec["direction"], value(spec["strength"]))
+    raise Exception("Unsupported Dynamics")
+
+
+def cell_values(value, rows, cols):
+    # a scalar, or per-cell values given as (rows, cols) or flat, as a flat array
+    if np.ndim(value) == 0:
+        return np.full(rows * cols, float(value))
+    return np.asarray(value, dtype=np.float64).reshape(rows * cols)
+
+
+class Slip:
+    # The classic model: the intended move with probability 1 - noise, each perpendicular move with
+    # noise / 2. noise defaults to the Gridworld's and may be given per cell (ice, mud).
+    moves = MOVES4
+
+    def __init__(self, noise=None) -> None:
+        self.noise = noise
+
+    @property
+    def actions(self):
+        return len(self.moves)
+
+    @property
+    def reach(self):
+        return 1
+
+    @property
+    def branching(self):
+        # outcomes per action, before outcomes landing on the same cell are merged
+        return 3
+
+    def sides(self, action):
+        return (action-1) % 4, (action+1) % 4
+
+    def outcomes(self, model):
+        noise = model.noise if self.noise is None else cell_values(self.noise, model.rows, model.cols)
+        for action in range(self.actions):
+            yield action, (self.moves[action],), 1 - noise
+            for side in self.sides(action):
+                yield action, (self.moves[side],), noise / 2
+
+    def crop(self, rows, cols, shape):
+        # the same dynamics on the window rows x cols (slices) of a map of the given shape
+        if self.noise is None or np.ndim(self.noise) == 0:
+            return self
+        return type(self)(np.asarray(self.noise).reshape(shape)[rows, cols])
+
+    def key(self):
+        noise = self.noise if self.noise is None or np.ndim(self.noise) == 0 else \
+            hashlib.sha1(np.ascontiguousarray(self.noise, dtype=np.float64).tobytes()).hexdigest()
+        return f"{type(self).__name__}({noise})"
+
+    def spec(self, arrays):
+        # JSON description for storage, per-cell noise goes into arrays
+        return {"kind": type(self).__name__, "noise": spec_value(self.noise, arrays)}
+
+
+class KingMoves(Slip):
+    # eight actions, slipping to the two neighbouring compass directions
+    moves = MOVES8
+
+    def sides(self, action):
+        turn = COMPASS8.index(action)
+        return COMPASS8[(turn-1) % 8], COMPASS8[(turn+1) % 8]
+
+
+class Wind:
+    # After every move of the base dynamics the wind pushes one more cell in direction with
+    # probability strength, a number or one value per cell of the map.
+    def __init__(self, base=None, direction=(-1, 0), strength=0.1) -> None:
+        self.base = Slip() if base is None else base
+        self.direction = tuple(direction)
+        self.strength = strength
+
+    @property
+    def actions(self):
+        return self.base.actions
+
+    @property
+    def reach(self):
+        return self.base.reach + max(abs(step) for step in self.direction)
+
+    @property
+    def branching(self):
+        return 2 * self.base.branching
+
+    def outcomes(self, model):
+        strength = cell_values(self.strength, model.rows, model.cols)
+        for action, path, prob in self.base.outcomes(model):
+            yield action, path, prob * (1 - strength)
+            yield action, path + (self.direction,), prob * strength
+
+    def crop(self, rows, cols, shape):
+        strength = self.strength
+        if np.ndim(strength) != 0:
+            strength = np.asarray(strength).reshape(shape)[rows, cols]
+        return Wind(self.base.crop(rows, cols, shape), self.direction, strength)
+
+    def key(self):
+        strength = self.strength if np.ndim(self.strength) == 0 else \
+            hashlib.sha1(np.ascontiguousarray(self.strength, dtype=np.float64).tobytes()).hexdigest()
+        return f"Wind({self.base.key()}, {self.direction}, {strength})"
+
+    def spec(self, arrays):
+        return {"kind": "Wind", "base": self.base.spec(arrays), "direction": list(self.direction),
+                "strength": spec_value(self.strength, arrays)}
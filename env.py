@@ -0,0 +1,54 @@
+from gridworld import Gridworld
+from compiled import CompiledGrid
+import numpy as np
+
+
+class VectorEnv:
+    # N agents on one map, stepped together. States are flat cell indices (row * cols + col).
+    # Every step pays the living reward; entering a terminal also pays discount * its utility and
+    # ends the episode, so discounted returns agree with the utilities the solvers compute.
+    def __init__(self, model: Gridworld, n=1, seed=None) -> None:
+        self.mdp = CompiledGrid(model)
+        self.rng = np.random.default_rng(seed)
+        self.n = n
+        self.states = None
+        self.final_states = None
+        self.terminal_reward = self.mdp.discount * np.where(self.mdp.terminal, self.mdp.util, 0)
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def sample_starts(self, n):
+        # uniform over the walkable cells
+        return self.mdp.states[self.rng.integers(len(self.mdp.states), size=n)]
+
+    def reset(self, n=None):
+        self.n = self.n if n is None else n
+        self.states = self.sample_starts(self.n)
+        return self.states.copy()
+
+    def step(self, states, actions):
+        # Returns next states, rewards and done flags. Finished episodes are reset straight away:
+        # their entries in the returned states are fresh starts, and the terminal cells they reached
+        # stay in final_states.
+        mdp = self.mdp
+        states = np.asarray(states, dtype=np.intp)
+        actions = np.asarray(actions, dtype=np.intp)
+        # a wall, terminal or off-map state, or a missing action, would read another state's row
+        if ((states < 0) | (states >= mdp.n)).any() or (mdp.position[states % mdp.n] < 0).any():
+            raise Exception("Unsupported State")
+        if ((actions < 0) | (actions >= mdp.actions)).any():
+            raise Exception("Unsupported Action")
+        nxt = mdp.sample(states, actions, self.rng.random(len(states)))
+        dones = mdp.terminal[nxt]
+        rewards = mdp.living_reward + self.terminal_reward[nxt]
+
+        self.final_states = nxt.copy()
+        finished = np.flatnonzero(dones)
+        if finished.size:
+            nxt[finished] = self.sample_starts(finished.size)
+        self.states = nxt
+        return nxt.copy(), rewards, dones
+
+    def coordinates(self, states):
+        return np.divmod(np.asarray(states), self.mdp.cols)
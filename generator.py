@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from gridworld import State
+from connectivity import WallPlacer
+import numpy as np
+import os
+import time
+
+
+class MapGenerator:
+    # Random maps as flat int8 state codes, laid out like Gridworld(random=True) maps:
+    # diamond/pit pairs for goal_ratio percent of the cells, then walls for wall_ratio percent that
+    # keep every open cell connected. Map i only depends on (seed, i), whatever the batch or worker
+    # it is made in. Cells are drawn from permutations of the free cells, never by retrying.
+    # search=False skips walls only a search could clear: several times faster on large maps, at the
+    # price of fewer loops in the open space.
+    def __init__(self, rows, cols, goal_ratio=10, wall_ratio=20, seed=None, search=True) -> None:
+        self.rows = rows
+        self.cols = cols
+        self.goal_ratio = goal_ratio
+        self.wall_ratio = wall_ratio
+        self.seed = np.random.SeedSequence(seed).entropy  # drawn once when None, so it can be reported
+        self.search = search
+        self.runtime = 0.0
+        self.maps_per_second = 0.0
+        self.missing_walls = 0
+
+    def generate(self, index=0):
+        # returns the codes of map index and the number of walls that could not be placed
+        # without cutting the map in two
+        n = self.rows * self.cols
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(index,)))
+        codes = np.full(n, State.WALKABLE.value, dtype=np.int8)
+
+        pairs = max(int(n * (self.goal_ratio / 100)) // 2, 1)
+        terminals = rng.choice(n, size=min(2 * pairs, n), replace=False)
+        codes[terminals[:pairs]] = State.DIAMOND.value
+        codes[terminals[pairs:]] = State.PIT.value
+
+        desired = int(n * (self.wall_ratio / 100))
+        placer = WallPlacer(codes, self.rows, self.cols)
+        placed = 0
+        for cell in rng.permutation(np.flatnonzero(codes == State.WALKABLE.value)).tolist():
+            if placed >= desired:
+                break
+            if placer.add_wall(cell, self.search):
+                placed += 1
+        return codes, desired - placed
+
+    def batch(self, count, start=0, workers=None, chunk=64):
+        # maps start..start+count-1 as one (count, rows * cols) int8 array, made chunk maps at a time
+        # over worker processes
+        start_time = time.perf_counter()
+        maps = np.empty((count, self.rows * self.cols), dtype=np.int8)
+        starts = list(range(start, start + count, chunk))
+        counts = [min(chunk, start + count - first) for first in starts]
+        workers = min(workers or os.cpu_count(), len(starts))
+        self.missing_walls = 0
+
+        if workers <= 1:
+            self._collect(maps, start, starts, map(_generate_chunk, repeat(self), starts, counts))
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                self._collect(maps, start, starts, pool.map(_generate_chunk, repeat(self), starts, counts))
+
+        self.runtime = time.perf_counter() - start_time
+        self.maps_per_second = count / max(self.runtime, 1e-12)
+        return maps
+
+    def _collect(self, maps, start, starts, results):
+        # chunks are copied in as they arrive, so at most a few are held besides maps
+        for first, (codes, missing) in zip(starts, results):
+            maps[first - start:first - start + len(codes)] = codes
+            self.missing_walls += missing
+
+
+def _generate_chunk(generator, start, count):
+    maps = np.empty((count, generator.rows * generator.cols), dtype=np.int8)
+    missing = 0
+    for offset in range(count):
+        maps[offset], short = generator.generate(start + offset)
+        missing += short
+    return maps, missing
@@ -1,8 +1,10 @@
-import pygame as pg
+from collections.abc import Mapping
 from enum import Enum, auto
 from settings import *
+from dynamics import MOVES8
+import numpy as np
 import math
-from random import randint
+from random import randint, sample
 
 
 class DisplayMode(Enum): 
@@ -17,15 +19,20 @@ class State(Enum):
     WALL = auto()
 
 
+STATE_COLORS = {State.DIAMOND: GREEN, State.PIT: RED, State.WALKABLE: BLACK, State.WALL: LIGHTGREY}
+RANDOM_TILE_TRIES = 32  # rejection draws before get_random_tile scans for the walkable cells
+
+
 class Triangle:
+    # a wedge of a tile coloured by one action's Q-value, a quadrilateral for the diagonal actions
     def __init__(self, color, points) -> None:
         self.color = color
         self.points = points
         self.value = 0.00
 
     def get_center(self):
-        p1, p2, p3 = self.points
-        return ((p1[0]+p2[0]+p3[0])/3, (p1[1]+p2[1]+p3[1])/3)
+        xs, ys = zip(*self.points)
+        return (sum(xs)/len(xs), sum(ys)/len(ys))
 
     def update_value(self, value):
         self.value = value
@@ -34,59 +41,131 @@ class Triangle:
     def _update_color(self):
         if 0 <= self.value:
             if self.value <= 1:
-                self.color = pg.Color(*[math.ceil(x * self.value) for x in GREEN])
+                self.color = tuple(math.ceil(x * self.value) for x in GREEN)
             else: self.color = GREEN
             
         elif self.value < 0:
             if self.value >= -1:
-                self.color = pg.Color(*[math.ceil(x * (-self.value)) for x in RED])
+                self.color = tuple(math.ceil(x * (-self.value)) for x in RED)
             else: 
                 self.color = RED
 
-        self.color.a = 255
-
 
 class Tile:
-    def __init__(self, row, col, state=State.WALKABLE) -> None:
+    # a lightweight view onto one cell of the Gridworld arrays
+    __slots__ = ("model", "row", "col", "index")
+
+    def __init__(self, model, row, col) -> None:
+        self.model = model
         self.row = row
         self.col = col
-        self.state = state
-        self.x = (col+.2) * TILESIZE
-        self.y = (row+.2) * TILESIZE
-        self.rect = pg.Rect(self.x, self.y, TILESIZE, TILESIZE)
-        self.color = BLACK
-        self._define_triangles()
-        self.util = 0.00
-        self.dir = 1 # U
-        self.aval = {0: 0, 1: 0, 2: 0, 3: 0}
-
-    def _define_triangles(self):
-        center = (self.x + TILESIZE/2, self.y + TILESIZE/2)
-        upper_tri = (self.x, self.y), (self.x+TILESIZE, self.y), center
-        lower_tri = (self.x, self.y+TILESIZE), (self.x+TILESIZE, self.y+TILESIZE), center
-        left_tri = (self.x, self.y), (self.x, self.y+TILESIZE), center
-        right_tri = (self.x+TILESIZE, self.y), (self.x+TILESIZE, self.y+TILESIZE), center
-        self.triangles = (Triangle(self.color, left_tri), Triangle(self.color, upper_tri), 
-                          Triangle(self.color, right_tri), Triangle(self.color, lower_tri))
-
-    def update_color(self, color):
-        self.color = color
-        for tri in self.triangles:
-            tri.color = color
+        self.index = row * model.cols + col
+
+    def __eq__(self, other):
+        return isinstance(other, Tile) and self.model is other.model and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.model), self.index))
+
+    @property
+    def state(self):
+        return State(int(self.model.codes[self.index]))
+
+    @state.setter
+    def state(self, state):
+        self.model.codes[self.index] = state.value
+
+    @property
+    def util(self):
+        return float(self.model.util[self.index])
+
+    @util.setter
+    def util(self, value):
+        self.model.util[self.index] = value
+
+    @property
+    def dir(self):
+        return int(self.model.dir[self.index])
+
+    @dir.setter
+    def dir(self, value):
+        self.model.dir[self.index] = value
+
+    @property
+    def aval(self):
+        return dict(enumerate(self.model.q[:, self.index].tolist()))
+
+    @property
+    def x(self):
+        return (self.col+.2) * TILESIZE
+
+    @property
+    def y(self):
+        return (self.row+.2) * TILESIZE
+
+    @property
+    def color(self):
+        return STATE_COLORS[self.state]
+
+    # rendering geometry is built from the cell position whenever it is drawn
+    @property
+    def rect(self):
+        import pygame as pg
+        return pg.Rect(self.x, self.y, TILESIZE, TILESIZE)
+
+    @property
+    def triangles(self):
+        x, y, color = self.x, self.y, self.color
+        center = (x + TILESIZE/2, y + TILESIZE/2)
+        upper_tri = (x, y), (x+TILESIZE, y), center
+        lower_tri = (x, y+TILESIZE), (x+TILESIZE, y+TILESIZE), center
+        left_tri = (x, y), (x, y+TILESIZE), center
+        right_tri = (x+TILESIZE, y), (x+TILESIZE, y+TILESIZE), center
+        triangles = (Triangle(color, left_tri), Triangle(color, upper_tri), 
+                     Triangle(color, right_tri), Triangle(color, lower_tri))
+        if len(self.model.q) == 8:
+            triangles = self.wedges()
+        if self.is_walkable():
+            for action, tri in enumerate(triangles):
+                tri.update_value(self.model.q[action, self.index])
+        return triangles
+
+    def wedges(self):
+        # eight 45 degree wedges around the centre in MOVES8 order (L, U, R, D, UL, UR, DR, DL),
+        # the same split as render.sectors
+        x, y, color = self.x, self.y, self.color
+        left, top, right, bottom = x, y, x+TILESIZE, y+TILESIZE
+        cx, cy = x + TILESIZE/2, y + TILESIZE/2
+        k = TILESIZE/2 * math.tan(math.pi/8)
+        center = (cx, cy)
+        points = ((center, (left, cy+k), (left, cy-k)), (center, (cx-k, top), (cx+k, top)),
+                  (center, (right, cy-k), (right, cy+k)), (center, (cx+k, bottom), (cx-k, bottom)),
+                  (center, (left, cy-k), (left, top), (cx-k, top)),
+                  (center, (cx+k, top), (right, top), (right, cy-k)),
+                  (center, (right, cy+k), (right, bottom), (cx+k, bottom)),
+                  (center, (cx-k, bottom), (left, bottom), (left, cy+k)))
+        return tuple(Triangle(color, wedge) for wedge in points)
 
     def draw(self, screen, mode: DisplayMode):
+        import pygame as pg
         if mode == DisplayMode.QVAL: 
-            for tri in self.triangles: 
+            triangles = self.triangles
+            for tri in triangles: 
                 pg.draw.polygon(screen, tri.color, tri.points)
                 
-            if self.is_walkable():
+            if self.is_walkable() and len(triangles) == 4:
                 pg.draw.line(screen, WHITE, (self.x, self.y),
                             (self.x+TILESIZE, self.y+TILESIZE), 2)
                 pg.draw.line(screen, WHITE, (self.x+TILESIZE, self.y),
                             (self.x, self.y+TILESIZE), 2)
+            elif self.is_walkable():
+                for tri in triangles[:4]:
+                    for point in tri.points[1:]:
+                        pg.draw.line(screen, WHITE, tri.points[0], point, 2)
                 
         if mode == DisplayMode.UTILxDIR: 
-            pg.draw.rect(screen, self.color, self.rect)
+            tile_rect = self.rect
+            pg.draw.rect(screen, self.color, tile_rect)
             
             # advised direction
             if self.is_walkable():
@@ -95,13 +174,21 @@ class Tile:
                 const = 2 * TILESIZE//20
                 match self.dir: 
                     case 0: 
-                        rect.center = self.rect.left + const, self.rect.center[1]
+                        rect.center = tile_rect.left + const, tile_rect.center[1]
                     case 1:
-                        rect.center = self.rect.center[0], self.rect.top + const
+                        rect.center = tile_rect.center[0], tile_rect.top + const
                     case 2:
-                        rect.center = self.rect.right - const, self.rect.center[1]
+                        rect.center = tile_rect.right - const, tile_rect.center[1]
                     case 3:
-                        rect.center = self.rect.center[0], self.rect.bottom - const
+                        rect.center = tile_rect.center[0], tile_rect.bottom - const
+                    case 4:
+                        rect.center = tile_rect.left + const, tile_rect.top + const
+                    case 5:
+                        rect.center = tile_rect.right - const, tile_rect.top + const
+                    case 6:
+                        rect.center = tile_rect.right - const, tile_rect.bottom - const
+                    case 7:
+                        rect.center = tile_rect.left + const, tile_rect.bottom - const
                     case _: 
                         raise Exception("Unsupported Direction")
                         
@@ -120,76 +207,174 @@ class Tile:
     def set_as_pit(self): 
         self.state = State.PIT 
         self.util = -1 
-        self.update_color(RED)
         
     def set_as_diamond(self): 
         self.state = State.DIAMOND
         self.util = 1 
-        self.update_color(GREEN)
         
     def set_as_wall(self): 
         self.state = State.WALL 
-        self.update_color(LIGHTGREY)
 
     def set_as_walkable(self): 
         self.state = State.WALKABLE
-        self.update_color(BLACK)
         
     def is_walkable(self):
-        return self.state == State.WALKABLE
+        return self.model.codes[self.index] == State.WALKABLE.value
 
     def is_pit(self):
-        return self.state == State.PIT
+        return self.model.codes[self.index] == State.PIT.value
 
     def is_diamond(self):
-        return self.state == State.DIAMOND
+        return self.model.codes[self.index] == State.DIAMOND.value
 
     def is_wall(self):
-        return self.state == State.WALL
+        return self.model.codes[self.index] == State.WALL.value
 
     def reset(self):
         self.util = 0
-        self.aval = {0: 0, 1: 0, 2: 0, 3: 0}
-        for tri in self.triangles:
-            tri.update_value(value=0)
+        self.model.q[:, self.index] = 0
         self.dir = 1
 
     def set_aval(self, action, exp_u):
-        left_tri, upper_tri, right_tri, lower_tri = self.triangles
-        self.aval[action] = exp_u
-        if action == 0:
-           left_tri.update_value(exp_u)
-        elif action == 1:
-            upper_tri.update_value(exp_u)
-        elif action == 2:
-            right_tri.update_value(exp_u)
-        elif action == 3:
-            lower_tri.update_value(exp_u)
+        self.model.q[action, self.index] = exp_u
 
     def get_state_coor(self): 
         return self.row, self.col 
+
+
+class TileMap(Mapping):
+    # (row, col) -> Tile lookups over the Gridworld arrays, tiles are created on access
+    def __init__(self, model) -> None:
+        self.model = model
+
+    def __getitem__(self, coor):
+        row, col = coor
+        if not (0 <= row < self.model.rows and 0 <= col < self.model.cols):
+            raise KeyError(coor)
+        return Tile(self.model, row, col)
+
+    def __iter__(self):
+        return ((i, j) for i in range(self.model.rows) for j in range(self.model.cols))
+
+    def __len__(self):
+        return self.model.rows * self.model.cols
     
     
 class Gridworld:
-    def __init__(self, number_of_rows, number_of_cols, random=False, goal_ratio=10, wall_ratio=20):
-        width, height = (number_of_cols+.4) * TILESIZE, (number_of_rows+.4) * TILESIZE
-        self._create_screen(width, height, TITLE)
+    def __init__(self, number_of_rows, number_of_cols, random=False, goal_ratio=10, wall_ratio=20, codes=None,
+                 seed=None):
+        self.screen = None
+        self.renderer = None
         self.rows = number_of_rows
         self.cols = number_of_cols
-        self._set_up_grid(random, goal_ratio, wall_ratio)
+        self._allocate()
+        if random and seed is not None:
+            # reproducible layouts come from generator.MapGenerator
+            from generator import MapGenerator
+            self.load_codes(MapGenerator(self.rows, self.cols, goal_ratio, wall_ratio, seed).generate()[0])
+        elif codes is None:
+            self._set_up_grid(random, goal_ratio, wall_ratio)
+        else:
+            self.load_codes(codes)
         self.noise = 0.2
         self.discount = .9
         self.living_reward = 0
+        self.dynamics = None  # see dynamics.py, None is the four-way Slip with self.noise
+        self.view = None  # "tiles", "heatmap" or None for the heatmap once the tiles do not fit in WINDOW
     
     def _create_screen(self, width, height, title):
+        import pygame as pg
         pg.init()
         self.screen = pg.display.set_mode((width, height))
         pg.display.set_caption(title)
         
+    def _allocate(self):
+        # structure-of-arrays storage, cell (row, col) lives at index row * cols + col
+        n = self.rows * self.cols
+        self.codes = np.full(n, State.WALKABLE.value, dtype=np.int8)
+        self.util = np.zeros(n)
+        self.dir = np.ones(n, dtype=np.int8)  # U
+        self.q = np.zeros((4, n))
+        self.edits = []
+        self.pending = None  # per-cell Bellman error bounds an incremental re-solve left below theta
+        self.grid = TileMap(self)
+
+    def copy(self):
+        model = Gridworld(self.rows, self.cols, codes=self.codes)
+        model.util[:] = self.util
+        model.dir[:] = self.dir
+        model.set_actions(len(self.q))
+        model.q[:] = self.q
+        model.noise = self.noise
+        model.discount = self.discount
+        model.living_reward = self.living_reward
+        model.dynamics = self.dynamics
+        model.view = self.view
+        model.edits = list(self.edits)
+        model.pending = None if self.pending is None else self.pending.copy()
+        return model
+
+    def set_actions(self, count):
+        # one row of Q-values per action, dynamics with more moves widen the table
+        if len(self.q) != count:
+            self.q = np.zeros((count, self.rows * self.cols))
+
+    @classmethod
+    def from_arrays(cls, rows, cols, codes, util, dir, q):
+        # wraps existing arrays (memory-mapped ones, for instance) without copying them
+        model = cls.__new__(cls)
+        model.screen = None
+        model.renderer = None
+        model.rows = rows
+        model.cols = cols
+        model.codes, model.util, model.dir, model.q = codes, util, dir, q
+        model.edits = []
+        model.pending = None
+        model.grid = TileMap(model)
+        model.noise = 0.2
+        model.discount = .9
+        model.living_reward = 0
+        model.dynamics = None
+        model.view = None
+        return model
+
+    def load_codes(self, codes):
+        # replaces the layout with a (rows, cols) or flat array of State values and clears the solution
+        self.codes[:] = np.asarray(codes, dtype=np.int8).ravel()
+        self.util[:] = 0
+        self.util[self.codes == State.DIAMOND.value] = 1
+        self.util[self.codes == State.PIT.value] = -1
+        self.q[:] = 0
+        self.dir[:] = 1
+        self.edits.clear()
+        self.pending = None
+
+    def edit(self, row, col, state: State):
+        # Changes one cell at runtime and keeps the rest of the solution. Changed cells are queued
+        # in edits until an incremental re-solve (incremental.PrioritizedSweeping) takes them.
+        index = row * self.cols + col
+        if self.codes[index] == state.value:
+            return False
+        self.codes[index] = state.value
+        self.util[index] = 1 if state == State.DIAMOND else -1 if state == State.PIT else 0
+        self.q[:, index] = 0
+        self.dir[index] = 1
+        self.edits.append(index)
+        return True
+
+    def set_wall(self, row, col):
+        return self.edit(row, col, State.WALL)
+
+    def set_walkable(self, row, col):
+        return self.edit(row, col, State.WALKABLE)
+
+    def set_pit(self, row, col):
+        return self.edit(row, col, State.PIT)
+
+    def set_diamond(self, row, col):
+        return self.edit(row, col, State.DIAMOND)
+
     def _set_up_grid(self, random, goal_ratio, wall_ratio):
-        self.grid = {(i, j): Tile(i, j)
-                    for i in range(self.rows) for j in range(self.cols)}
-        
         if not random:
             self.grid[(0, self.cols-1)].set_as_diamond()
             self.grid[(1, self.cols-1)].set_as_pit()
@@ -200,19 +385,27 @@ class Gridworld:
             self.spawn_walls(wall_ratio)    
         
     def get_random_tile(self): 
-        row, col = randint(0, self.rows-1), randint(0, self.cols-1)
-        while not self.grid[(row, col)].is_walkable(): 
-            row, col = randint(0, self.rows-1), randint(0, self.cols-1)
-        return self.grid[(row, col)]
+        # a few rejection draws, then the walkable cells directly so a near-full map needs no retries
+        for _ in range(RANDOM_TILE_TRIES):
+            index = randint(0, self.rows * self.cols - 1)
+            if self.codes[index] == State.WALKABLE.value:
+                return self.grid[divmod(index, self.cols)]
+        walkable = np.flatnonzero(self.codes == State.WALKABLE.value)
+        if not walkable.size:
+            raise Exception("No Walkable Tile")
+        return self.grid[divmod(int(walkable[randint(0, walkable.size-1)]), self.cols)]
               
     def spawn_terminals(self, percent): 
         amount = int((self.rows * self.cols) * (percent / 100)) // 2
         desired_pairs = amount if amount != 0 else 1
-        for _ in range(desired_pairs): 
-            diamond = self.get_random_tile()
-            diamond.set_as_diamond()
-            pit = self.get_random_tile()
-            pit.set_as_pit()
+        # every pair from one draw without replacement, diamonds and pits alternating
+        walkable = np.flatnonzero(self.codes == State.WALKABLE.value).tolist()
+        if len(walkable) < 2 * desired_pairs:
+            raise Exception("No Walkable Tile")
+        cells = sample(walkable, 2 * desired_pairs)
+        for diamond, pit in zip(cells[::2], cells[1::2]): 
+            self.grid[divmod(diamond, self.cols)].set_as_diamond()
+            self.grid[divmod(pit, self.cols)].set_as_pit()
                                                    
     def add_wall_safely(self, tile: Tile):
         tile.set_as_wall()
@@ -222,15 +415,17 @@ class Gridworld:
         return True
             
     def spawn_walls(self, percent):
+        from connectivity import WallPlacer
         desired_walls = int((self.rows * self.cols) * (percent / 100))
         placed_walls = 0
+        placer = WallPlacer(self.codes, self.rows, self.cols)
         
         while True: 
-            for tile in self.grid.values():
+            for index in range(self.rows * self.cols):
                 if placed_walls >= desired_walls:
                     return
-                if randint(1, 100) < percent and tile.is_walkable():
-                    if self.add_wall_safely(tile):
+                if randint(1, 100) < percent and self.codes[index] == State.WALKABLE.value:
+                    if placer.add_wall(index):
                         placed_walls += 1
                             
     def is_fully_connected(self): 
@@ -262,58 +457,70 @@ class Gridworld:
         return all_connected 
                  
     def wipe(self):
-        for tile in self.grid.values():
-            if not (tile.is_diamond() or tile.is_pit() or tile.is_wall()):
-                tile.reset()
+        walkable = self.codes == State.WALKABLE.value
+        self.util[walkable] = 0
+        self.q[:, walkable] = 0
+        self.dir[walkable] = 1
+        self.edits.clear()
+        self.pending = None
                 
     def draw_Q_values(self, tile: Tile):
-        text_font = pg.font.SysFont("Arials", TILESIZE//5)
-        for tri in tile.triangles:
+        from render import LABELS
+        triangles = tile.triangles
+        size = TILESIZE//5 if len(triangles) == 4 else TILESIZE//7
+        for tri in triangles:
             text = '%.2f' % tri.value
-            img = text_font.render(text, True, WHITE)
+            img = LABELS.render(text, size, WHITE)
             rect = img.get_rect()
             rect.center = tri.get_center()
             self.screen.blit(img, rect.topleft)
 
     def draw_V_values(self, tile: Tile):
-        text_font = pg.font.SysFont("Arials", TILESIZE//4)
+        from render import LABELS
         text = '%.2f' % tile.util
-        img = text_font.render(text, True, WHITE)
+        img = LABELS.render(text, TILESIZE//4, WHITE)
         rect = img.get_rect()
         rect.center = tile.rect.center
         self.screen.blit(img, rect.topleft)
         
     def display(self, mode: DisplayMode):
-        self.screen.fill(BLACK)
-        
-        for tile in self.grid.values():
-            tile.draw(self.screen, mode)
-            if tile.is_walkable():
-                if mode == DisplayMode.QVAL:
-                    self.draw_Q_values(tile)
-                elif mode == DisplayMode.UTILxDIR:
-                    self.draw_V_values(tile)
-                    
-        pg.display.flip()
+        if self.screen is None:
+            from render import Renderer, HeatmapRenderer
+            width, height = (self.cols+.4) * TILESIZE, (self.rows+.4) * TILESIZE
+            view = self.view
+            if view is None:
+                view = "tiles" if width <= WINDOW[0] and height <= WINDOW[1] else "heatmap"
+            if view == "tiles":
+                self._create_screen(width, height, TITLE)
+                self.renderer = Renderer(self)
+            elif view == "heatmap":
+                self._create_screen(min(width, WINDOW[0]), min(height, WINDOW[1]), TITLE)
+                self.renderer = HeatmapRenderer(self)
+            else:
+                raise Exception("Unsupported View")
+        self.renderer.draw(mode)
         
     def commit(self, state: Tile, action_index: int):
-        actions = [(0, -1), (-1, 0), (0, 1), (1, 0)]  # L, U, R, D
-        dr, dc = actions[action_index]
+        # the intended move of an action, without the noise of the dynamics
+        if not 0 <= action_index < len(self.q):
+            raise Exception("Unsupported Action")
+        dr, dc = MOVES8[action_index]  # L, U, R, D, then UL, UR, DR, DL
         newr, newc = state.row + dr, state.col + dc
         if newr < 0 or newc < 0 or newr >= self.rows or newc >= self.cols \
-                or self.grid[(newr, newc)].is_wall():
+                or self.codes[newr * self.cols + newc] == State.WALL.value:
             return state
         else:
-            return self.grid[(newr, newc)]
+            return Tile(self, newr, newc)
 
     
 def draw_text(screen, text, size, text_color, x, y):
-    text_font = pg.font.SysFont("Arials", size)
-    img = text_font.render(text, True, text_color)
+    from render import LABELS
+    img = LABELS.render(text, size, text_color)
     screen.blit(img, (x, y))
 
 
 if __name__ == "__main__": 
+    import pygame as pg
     grid = Gridworld(6, 6, True, wall_ratio=25)
     print(grid.is_fully_connected())
     grid.display(DisplayMode.UTILxDIR)
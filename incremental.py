@@ -0,0 +1,173 @@
+from gridworld import Gridworld, DisplayMode
+from compiled import CompiledGrid, gather
+from optimalPolicy import MDPSolver, ValueIteration
+from heapq import heapify, heappush, heappop
+import numpy as np
+
+
+def influence(mdp: CompiledGrid):
+    # reverse CSR over cells: the positions of the walkable states that can move into each cell and
+    # the largest probability any of their actions does so with
+    t, m = mdp.transitions, len(mdp.states)
+    sources = np.repeat(np.arange(len(t)) % m, np.diff(t.indptr))
+    pairs = t.indices.astype(np.int64) * m + sources
+    order = np.argsort(pairs, kind="stable")
+    pairs, probs = pairs[order], t.probs[order]
+    starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]])
+    weights = np.maximum.reduceat(probs, starts)
+    targets, sources = np.divmod(pairs[starts], m)
+    indptr = np.zeros(mdp.n + 1, dtype=np.intp)
+    np.cumsum(np.bincount(targets, minlength=mdp.n), out=indptr[1:])
+    return indptr, sources, weights
+
+
+class PrioritizedSweeping(MDPSolver):
+    # Re-solves a solved map after Gridworld.edit calls. The states whose transitions can touch an
+    # edited cell are backed up first, then states are taken from a priority queue ordered by a bound
+    # on their Bellman error: a change d of V(s) raises the bound of every predecessor p by
+    # discount * max_a P(s | p, a) * |d|. The queue is drained once every bound is below theta, so
+    # every Bellman error ends below theta; the bounds left are kept in model.pending for the next
+    # re-solve, where they keep growing instead of starting from zero. Edits felt across the whole map
+    # outgrow the queue: after budget sweeps' worth of state backups it hands over to NumPy value
+    # iteration from the current values (None keeps the queue to the end).
+    name = "value"
+
+    def __init__(self, model: Gridworld, budget=1) -> None:
+        super().__init__(model)
+        self.budget = budget
+        self.updates = 0
+        self.touched = 0
+        self.handed_over = False
+
+    def __call__(self, theta=0.0001, display_result=False, display_mode=DisplayMode.QVAL):
+        with self.run(display_result, display_mode):
+            self.updates = 0
+            self.touched = 0
+            self.handed_over = False
+            mdp = self.compile()
+            if len(mdp.states):
+                self.influence = influence(mdp)
+                self.sweep_queue(theta, self.seeds())
+            if self.handed_over:
+                solver = ValueIteration(self.model, backend="numpy")
+                for hook in self.hooks:
+                    solver.subscribe(hook)
+                solver(theta=theta, display_result=False)
+                self.iterations += solver.iterations
+                self.backups += solver.backups
+                self.model.pending = None
+            self.model.edits.clear()
+
+    def seeds(self):
+        # walkable positions within reach of an edited cell
+        mdp, reach = self.mdp, self.mdp.dynamics.reach
+        seeds = set()
+        for index in self.model.edits:
+            row, col = divmod(index, mdp.cols)
+            rows = np.arange(max(row - reach, 0), min(row + reach + 1, mdp.rows))
+            cols = np.arange(max(col - reach, 0), min(col + reach + 1, mdp.cols))
+            positions = mdp.position[(rows[:, None] * mdp.cols + cols).ravel()]
+            seeds.update(positions[positions >= 0].tolist())
+        return sorted(seeds)
+
+    def sweep_queue(self, theta, seeds):
+        mdp, actions = self.mdp, self.mdp.actions
+        indptr, indices, probs, rewards, _ = mdp.python_rows()
+        rindptr, rsources, rweights = (array.tolist() for array in self.influence)
+        states = mdp.states.tolist()
+        util = mdp.util.tolist()
+        gamma, m = mdp.discount, len(states)
+        pending = self.model.pending
+        if pending is None:
+            # after a full solve: its residuals, measured in one array sweep
+            self.backups += mdp.actions * m
+            bound = np.abs(mdp.bellman(mdp.util).max(axis=0) - mdp.util[mdp.states]).tolist()
+        else:
+            bound = pending[mdp.states].tolist()
+        backed_up = np.zeros(m, dtype=bool)
+        heap = [(-value, position) for position, value in enumerate(bound) if value]
+        for position in seeds:
+            bound[position] = float("inf")
+            heap.append((-bound[position], position))
+        heapify(heap)
+
+        batch = 0
+        while heap:
+            priority, position = heappop(heap)
+            if -priority != bound[position]:
+                continue  # superseded by a later push
+            if bound[position] < theta:
+                break
+            bound[position] = 0.0
+            cell = states[position]
+            best = -float("inf")
+            for action in range(actions):
+                row = action * m + position
+                expu = 0
+                for k in range(indptr[row], indptr[row+1]):
+                    expu += probs[k] * (rewards[k] + gamma * util[indices[k]])
+                best = max(best, expu)
+            change = abs(best - util[cell])
+            util[cell] = best
+            backed_up[position] = True
+            batch += 1
+            if change:
+                for k in range(rindptr[cell], rindptr[cell+1]):
+                    source = rsources[k]
+                    bound[source] += gamma * rweights[k] * change
+                    heappush(heap, (-bound[source], source))
+            if batch == m:
+                self.end_batch(batch, heap, util)
+                batch = 0
+                if self.budget is not None and self.iterations >= self.budget:
+                    self.handed_over = True
+                    break
+        if batch or not self.iterations:
+            self.end_batch(batch, heap, util)
+        self.touched = int(np.count_nonzero(backed_up))
+        if self.handed_over:
+            self.model.util[mdp.states] = np.array(util)[mdp.states]
+        else:
+            self.model.pending = np.zeros(mdp.n)
+            self.model.pending[mdp.states] = bound
+            self.finish(np.array(util), np.flatnonzero(backed_up))
+
+    def end_batch(self, batch, heap, util):
+        # one event per states-count of state backups, a sweep's worth of work
+        self.updates += batch
+        self.iterations += 1
+        self.backups += self.mdp.actions * batch
+        if self.syncs_model():
+            self.model.util[self.mdp.states] = np.array(util)[self.mdp.states]
+        delta = -heap[0][0] if heap else 0.0
+        self.emit("sweep", iteration=self.iterations, delta=float(delta), backups=self.mdp.actions * batch)
+
+    def finish(self, util, positions):
+        # Q-values and directions of the backed-up states and of their predecessors, whose
+        # successors' values changed
+        mdp = self.mdp
+        indptr, sources, _ = self.influence
+        positions = np.union1d(positions, sources[gather(indptr, mdp.states[positions])[0]])
+        q = mdp.bellman(util, positions)
+        self.backups += q.size
+        cells = mdp.states[positions]
+        self.model.util[mdp.states] = util[mdp.states]
+        self.model.q[:, cells] = q
+        self.model.dir[cells] = np.argmax(q, axis=0)
+
+    def residual(self):
+        # largest Bellman error of the current values, one full sweep of backups not counted in backups
+        mdp = CompiledGrid(self.model)
+        util = self.model.util
+        return float(np.abs(mdp.bellman(util).max(axis=0) - util[mdp.states]).max(initial=0))
+
+    def compare(self, theta=0.0001):
+        # backups against ValueIteration solving the edited map from scratch, and the largest
+        # difference between the two solutions
+        full = self.model.copy()
+        full.wipe()
+        solver = ValueIteration(full, backend="numpy")
+        solver(theta=theta, display_result=False)
+        return {"backups": self.backups, "full_backups": solver.backups,
+                "ratio": self.backups / max(solver.backups, 1), "residual": self.residual(),
+                "max_difference": float(np.abs(full.util - self.model.util).max(initial=0))}
@@ -0,0 +1,54 @@
+from gridworld import Gridworld, State
+from compiled import CompiledGrid
+import numpy as np
+
+
+def coarsen(model: Gridworld, block=2):
+    # One coarse cell per block x block cells: a diamond if the block holds one, otherwise a pit
+    # if it holds one, a wall if it is all walls, walkable otherwise. A coarse step stands for
+    # block fine steps, so discount and living reward are compounded to match.
+    rows, cols = -(-model.rows // block), -(-model.cols // block)
+    codes = np.full((rows * block, cols * block), State.WALL.value, dtype=np.int8)
+    codes[:model.rows, :model.cols] = model.codes.reshape(model.rows, model.cols)
+    blocks = codes.reshape(rows, block, cols, block).swapaxes(1, 2).reshape(rows, cols, -1)
+
+    coarse = np.full((rows, cols), State.WALKABLE.value, dtype=np.int8)
+    coarse[(blocks == State.WALL.value).all(axis=2)] = State.WALL.value
+    coarse[(blocks == State.PIT.value).any(axis=2)] = State.PIT.value
+    coarse[(blocks == State.DIAMOND.value).any(axis=2)] = State.DIAMOND.value
+
+    # the coarse map keeps the default slip dynamics: it only seeds the fine sweeps, which converge
+    # to the values of the fine dynamics from any start
+    result = Gridworld(rows, cols, codes=coarse)
+    result.noise = model.noise
+    result.discount = model.discount ** block
+    result.living_reward = model.living_reward * sum(model.discount ** k for k in range(block))
+    return result
+
+
+def upper_bound(model: Gridworld):
+    # No policy reaches a terminal in fewer steps than its breadth-first distance, so
+    # V* <= r/(1-g) + max(0, g^d (u - r/(1-g))) over the diamonds and the pits (utility u, distance d).
+    mdp = CompiledGrid(model)
+    gamma, forever = mdp.discount, mdp.living_reward / (1 - mdp.discount)
+    bound = np.zeros(mdp.n)
+    for state in (State.DIAMOND, State.PIT):
+        sources = mdp.codes == state.value
+        if not sources.any():
+            continue
+        dist = mdp.distances(sources)
+        reached = dist >= 0
+        gain = mdp.util[sources].max() - forever
+        bound[reached] = np.maximum(bound[reached], gamma ** dist[reached] * gain)
+    return forever + bound
+
+
+def prolong(coarse: Gridworld, model: Gridworld, block=2):
+    # Every walkable fine cell starts from the value and direction of its coarse cell. Coarse moves
+    # ignore the walls inside a block, so values are capped where the fine map is slower to reach a
+    # terminal: overestimates only fade by a factor of the discount per sweep.
+    rows, cols = np.divmod(np.arange(model.rows * model.cols), model.cols)
+    parent = (rows // block) * coarse.cols + cols // block
+    walkable = model.codes == State.WALKABLE.value
+    model.util[walkable] = np.minimum(coarse.util[parent], upper_bound(model))[walkable]
+    model.dir[walkable] = coarse.dir[parent[walkable]]
@@ -1,14 +1,84 @@
-from gridworld import Tile, Gridworld, DisplayMode
-import pygame as pg
+from gridworld import Tile, Gridworld, DisplayMode, State
+from compiled import CompiledGrid
+from backends import BACKENDS, resolve
+from multigrid import coarsen, prolong
+from telemetry import DisplaySink
+from contextlib import contextmanager
+import numpy as np
+import math
+import time
 
 
 class MDPSolver:
+    name = None
+
     def __init__(self, model: Gridworld):
         self.model = model
-        self.clock = pg.time.Clock()
+        self.mdp = None
+        self.selected = None
+        self.hooks = []
+        self.iterations = 0
+        self.backups = 0
+        self.runtime = 0.0
+
+    def subscribe(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def unsubscribe(self, hook):
+        self.hooks.remove(hook)
+
+    def syncs_model(self):
+        # hooks that read the Gridworld need array backends to write back after every sweep
+        return any(getattr(hook, "needs_model", False) for hook in self.hooks)
+
+    def emit(self, phase, **fields):
+        if not self.hooks:
+            return
+        now = time.perf_counter()
+        event = {"solver": self.name, "phase": phase, "elapsed": now - self._start,
+                 "duration": now - self._last, **fields}
+        self._last = now
+        for hook in self.hooks:
+            hook(event)
+
+    @contextmanager
+    def run(self, display_result, display_mode):
+        self.iterations = 0
+        self.backups = 0
+        self.states_count = self.count_states()
+        self._start = self._last = time.perf_counter()
+        sink = self.subscribe(DisplaySink(self.model, display_mode)) if display_result else None
+        try:
+            yield
+        finally:
+            self.runtime = time.perf_counter() - self._start
+            if sink is not None:
+                self.unsubscribe(sink)
         
+    def compile(self):
+        # the transition table every backup of this solve reads
+        self.mdp = CompiledGrid(self.model)
+        if self.selected is not None:
+            self.mdp.kernel = self.selected.kernel()
+        self.model.set_actions(self.mdp.actions)
+        self._rows = None
+        return self.mdp
+
+    def check_backend(self, backend):
+        if backend != "auto" and backend not in BACKENDS:
+            raise Exception("Unsupported Backend")
+
+    def select_backend(self, theta):
+        # resolves "auto" for this solve, the choice is kept in self.selected
+        self.selected = resolve(self.backend, self.model, theta)
+        return self.selected
+
     def get_states(self):
         return self.model.grid.values()
+
+    def count_states(self):
+        return int(np.count_nonzero(self.model.codes == State.WALKABLE.value))
     
     def decode_policy(self, pi):
         for key, value in pi.items():
@@ -34,48 +104,315 @@ class MDPSolver:
         return arg, max
 
     def estimate_util(self, state, action): 
-        mdl = self.model
-        reward, gamma, noise, commit = mdl.living_reward, mdl.discount, mdl.noise, mdl.commit
-        expu = (1-noise) * (reward + gamma * commit(state, action).util)
-        expu += (noise/2) * (reward + gamma * commit(state, (action-1)%4).util)
-        expu += (noise/2) * (reward + gamma * commit(state, (action+1)%4).util)
+        if self._rows is None:
+            self._rows = self.mdp.python_rows()
+        indptr, indices, probs, rewards, position = self._rows
+        util, gamma = self.model.util, self.model.discount
+        row = action * len(self.mdp.states) + position[state.index]
+        expu = 0
+        for k in range(indptr[row], indptr[row+1]):
+            expu += probs[k] * (rewards[k] + gamma * util[indices[k]])
         return expu
 
 
 class ValueIteration(MDPSolver):
-    def __init__(self, model: Gridworld) -> None:
+    name = "value"
+    # sweep: "jacobi" backs up from the previous sweep, "gauss-seidel" in place and "ordered" in place
+    # by distance from the terminals; omega over-relaxes every backup. multigrid solves the map
+    # coarsened by block first and starts from its prolonged values. stopping "span" returns the
+    # midpoint of the bounds on V*, "epsilon" stops once the greedy policy loses less than epsilon;
+    # eliminate drops every action whose upper Q* bound is below the state's lower V* bound
+
+    def __init__(self, model: Gridworld, backend="auto", sweep="jacobi", omega=1.0,
+                 multigrid=False, block=2, stopping="delta", epsilon=None, eliminate=False) -> None:
         super().__init__(model)
+        self.check_backend(backend)
+        if sweep not in ("jacobi", "gauss-seidel", "ordered"):
+            raise Exception("Unsupported Sweep")
+        if stopping not in ("delta", "span", "epsilon"):
+            raise Exception("Unsupported Stopping")
+        if (stopping != "delta" or eliminate) and (sweep != "jacobi" or omega != 1):
+            # the value bounds hold for plain Jacobi backups only
+            raise Exception("Unsupported Sweep")
+        if multigrid and model.discount >= 1:
+            # the value cap needs discounting, and undiscounted sweeps never pull an overestimate down
+            raise Exception("Unsupported Discount")
+        self.backend = backend
+        self.sweep = sweep
+        self.omega = omega
+        self.multigrid = multigrid
+        self.block = block
+        self.coarse_sweeps = []
+        self.coarse_runtime = 0.0
+        self.stopping = stopping
+        self.epsilon = epsilon
+        self.eliminate = eliminate
+        self.active = None
+        self.loss_bound = math.inf
+        self.skipped_backups = 0
+        self.sweeps_saved = 0
 
     def eval_qstar(self, state: Tile, action: int):
         exp_u = self.estimate_util(state, action)
         state.set_aval(action, exp_u)
 
+    def arg_max(self, state):
+        if self.active is None:
+            return super().arg_max(state)
+        active = self.active[:, self.mdp.position[state.index]]
+        arg, max = None, -float('inf')
+        for dir, value in state.aval.items():
+            if active[dir] and value > max:
+                arg = dir
+                max = value
+        return arg, max
+
+    def relax(self, old, new):
+        # successive over-relaxation, omega == 1 keeps the plain backup
+        return new if self.omega == 1 else old + self.omega * (new - old)
+
+    def check_delta(self, delta):
+        if not math.isfinite(delta):
+            raise Exception("Sweep diverged, lower omega")
+
+    def update_order(self, mdp: CompiledGrid):
+        # positions into mdp.states, in the order the in-place sweeps visit them
+        positions = np.arange(len(mdp.states))
+        if self.sweep == "ordered":
+            dist = mdp.distances()[mdp.states]
+            dist[dist < 0] = dist.max(initial=0) + 1
+            positions = np.argsort(dist, kind="stable")
+        return positions
+
+    def update_groups(self, mdp: CompiledGrid):
+        # batches of positions updated together by the numpy backend, later batches see earlier results
+        if self.sweep == "jacobi":
+            return [slice(None)]
+        if self.sweep == "gauss-seidel":
+            # red-black ordering: with four-way moves a cell's successors are its neighbours or itself,
+            # never the same colour; other dynamics keep the two batches as an ordering
+            rows, cols = np.divmod(mdp.states, mdp.cols)
+            color = (rows + cols) % 2
+            return [np.flatnonzero(color == 0), np.flatnonzero(color == 1)]
+        order = self.update_order(mdp)
+        dist = mdp.distances()[mdp.states][order]
+        return np.split(order, np.flatnonzero(np.diff(dist)) + 1)
+
+    def initialize_coarse(self, theta):
+        # Solves the map coarsened into block x block cells (itself coarse-to-fine) and starts
+        # from its values. coarse_sweeps lists the sweeps per level, the coarsest first.
+        self.coarse_sweeps = []
+        self.coarse_runtime = 0.0
+        mdl = self.model
+        if min(mdl.rows, mdl.cols) < 2 * self.block:
+            return
+        coarse = coarsen(mdl, self.block)
+        solver = ValueIteration(coarse, self.selected.name, self.sweep, self.omega, True, self.block)
+        solver(theta=theta, display_result=False)
+        prolong(coarse, mdl, self.block)
+        self.coarse_sweeps = solver.coarse_sweeps + [solver.iterations]
+        self.coarse_runtime = solver.runtime
+        self.backups += solver.backups
+
+    def uses_bounds(self):
+        return self.stopping != "delta" or self.eliminate
+
     def __call__(self, theta=0.0001, display_result=True, display_mode=DisplayMode.QVAL):
+        with self.run(display_result, display_mode):
+            self.loss_bound = math.inf
+            self.skipped_backups = 0
+            self.sweeps_saved = 0
+            self._span = self._last_delta = None
+            if self.uses_bounds() and self.model.discount >= 1:
+                raise Exception("Bounds need a discount below 1")
+            self.select_backend(theta)
+            if self.multigrid:
+                self.initialize_coarse(theta)
+            self.compile()
+            self.active = np.ones((self.mdp.actions, len(self.mdp.states)), dtype=bool) if self.eliminate else None
+            self._pruned = None
+            if self.selected.arrays:
+                self.sweep_arrays(theta)
+            else:
+                self.sweep_tiles(theta)
+
+    def end_sweep(self, delta, backups=None):
+        full = self.mdp.actions * self.states_count
+        backups = full if backups is None else backups
+        self.iterations += 1
+        self.backups += backups
+        self.skipped_backups += full - backups
+        self.check_delta(delta)
+        self.emit("sweep", iteration=self.iterations, delta=float(delta), backups=backups)
+
+    def tighten(self, change, new_util, q):
+        # MacQueen bounds after a Jacobi sweep V -> V' = V + change: V' + g/(1-g) lo <= V* <= V' + g/(1-g) hi.
+        # Terminal utilities never change, so their zero change takes part.
+        lo, hi = change.min(initial=np.inf), change.max(initial=-np.inf)
+        if self.mdp.terminal.any() or not change.size:
+            lo, hi = min(lo, 0.0), max(hi, 0.0)
+        self._span = (lo, hi)
+        gamma = self.mdp.discount
+        # the greedy policy loses at most this much against the optimal one
+        self.loss_bound = gamma / (1 - gamma) * (hi - lo)
+        if self.active is not None:
+            # Q*(s, a) <= q(s, a) + g/(1-g) hi, so a is never optimal once that is below the lower
+            # bound on V*(s): such actions are dropped for the rest of the solve
+            self.active &= new_util - q <= self.loss_bound
+
+    def stop(self, delta, theta):
+        done = delta < theta
+        if not done and self.stopping != "delta":
+            lo, hi = self._span
+            if self.stopping == "span":
+                # the midpoint of the bounds is within theta of V*, as good as the max-delta test
+                done = hi - lo < 2 * theta
+            else:
+                gamma = self.mdp.discount
+                # default: the policy guarantee of the max-delta test at the same theta
+                epsilon = 2 * gamma * theta / (1 - gamma) if self.epsilon is None else self.epsilon
+                done = self.loss_bound < epsilon
+            if done:
+                # sweeps the max-delta test would still have run, at the contraction rate of the last sweep
+                rate = self.mdp.discount if self._last_delta is None else min(delta / self._last_delta, self.mdp.discount)
+                self.sweeps_saved = math.ceil(math.log(theta / delta) / math.log(rate)) if 0 < rate < 1 else 0
+        self._last_delta = delta
+        return done
+
+    def finish(self, util, q):
+        # span stopping returns the midpoint of the bounds, eliminated actions get their Q-values
+        # back from the final values and never win the argmax
+        mdp = self.mdp
+        if self.stopping == "span" and self._span is not None:
+            util[mdp.states] += mdp.discount / (1 - mdp.discount) * sum(self._span) / 2
+        if self.active is not None:
+            dropped = np.flatnonzero(~self.active.ravel())
+            if dropped.size:
+                block = mdp.transitions.take(dropped)
+                q.ravel()[dropped] = block.reward + mdp.discount * mdp.expect(block, util)
+                self.backups += dropped.size
+        mdp.write_back(self.model, util, q)
+        if self.active is not None:
+            self.model.dir[mdp.states] = np.argmax(np.where(self.active, q, -np.inf), axis=0)
+
+    def sweep_tiles(self, theta):
+        order = None
+        if self.sweep != "jacobi":
+            mdp = self.mdp
+            order = [self.model.grid[divmod(int(index), mdp.cols)]
+                     for index in mdp.states[self.update_order(mdp)]]
+
+        states = self.mdp.states
         while True:            
-            for state in self.get_states():
-                if state.is_walkable():
-                    for action in range(4):
+            backups = None if self.active is None else int(np.count_nonzero(self.active))
+            if order is None:
+                change = self.jacobi_sweep()
+                delta = np.abs(change).max(initial=0)
+            else:
+                delta = self.in_place_sweep(order)
+            if self.uses_bounds():
+                self.tighten(change, self.model.util[states], self.model.q[:, states])
+            self.end_sweep(delta, backups)
+                
+            if self.stop(delta, theta):
+                break
+        if self.uses_bounds():
+            self.finish(self.model.util, self.model.q[:, states])
+
+    def jacobi_sweep(self):
+        # returns the change of every walkable state's value
+        active, position = self.active, self.mdp.position
+        for state in self.get_states():
+            if state.is_walkable():
+                for action in range(self.mdp.actions):
+                    if active is None or active[action, position[state.index]]:
                         self.eval_qstar(state, action)
 
-            delta = 0
-            for state in self.get_states():
-                if state.is_walkable():
-                    dir, new_util = self.arg_max(state)
-                    delta = max(delta, abs(state.util - new_util))
-                    state.util = new_util
-                    state.dir = dir
-                    
-            if display_result: 
-                self.clock.tick(4)
-                self.model.display(display_mode)
-                
-            if delta < theta:
+        change = []
+        for state in self.get_states():
+            if state.is_walkable():
+                dir, new_util = self.arg_max(state)
+                change.append(new_util - state.util)
+                state.util = self.relax(state.util, new_util)
+                state.dir = dir
+        return np.array(change)
+
+    def in_place_sweep(self, order):
+        delta = 0
+        for state in order:
+            for action in range(self.mdp.actions):
+                self.eval_qstar(state, action)
+            dir, new_util = self.arg_max(state)
+            delta = max(delta, abs(state.util - new_util))
+            state.util = self.relax(state.util, new_util)
+            state.dir = dir
+        return delta
+
+    def sweep_arrays(self, theta):
+        mdp = self.mdp
+        util, states = mdp.util, mdp.states
+        groups = self.update_groups(mdp)
+        q = np.zeros((mdp.actions, len(states)))
+        while True:
+            delta, backups = 0, None
+            for positions in groups:
+                cells = states[positions]
+                if self.active is None:
+                    q[:, positions] = mdp.bellman(util, positions)
+                    new_util = q[:, positions].max(axis=0)
+                else:
+                    backups = self.bellman_active(util, q)
+                    new_util = np.where(self.active, q, -np.inf).max(axis=0)
+                change = new_util - util[cells]
+                delta = max(delta, np.abs(change).max(initial=0))
+                util[cells] = self.relax(util[cells], new_util)
+
+            if self.uses_bounds():
+                self.tighten(change, new_util, q)  # Jacobi: one group holding every state
+            if self.syncs_model():
+                mdp.write_back(self.model, util, q)
+            self.end_sweep(delta, backups)
+
+            if self.stop(delta, theta):
                 break
 
+        if self.uses_bounds():
+            self.finish(util, q)
+        else:
+            mdp.write_back(self.model, util, q)
+
+    def bellman_active(self, util, q):
+        # Backs up the rows of the actions not eliminated into q and returns how many. The rows are
+        # re-gathered once a sixteenth of them has been eliminated, until then dropped rows still run.
+        mdp = self.mdp
+        if self._pruned is None:
+            self._pruned = (slice(None), mdp.transitions, len(mdp.transitions))
+        elif np.count_nonzero(self.active) < self._pruned[2] * 15 // 16:
+            rows = np.flatnonzero(self.active.ravel())
+            self._pruned = (rows, mdp.transitions.take(rows), len(rows))
+        rows, block, count = self._pruned
+        q.ravel()[rows] = block.reward + mdp.discount * mdp.expect(block, util)
+        return count
+
+
+TIE = 1e-12  # relative Q-value gain below which improvement keeps the current action, rounding is not a gain
+
 
 class PolicyIteration(MDPSolver):
-    def __init__(self, model: Gridworld, pi: set) -> None:
+    name = "policy"
+    # evaluation: "iterative" sweeps to theta, "modified" runs a fixed number of sweeps per round and
+    # "exact" solves (I - discount * P_pi) V = R with scipy, linear_solver "direct" or "gmres"
+
+    def __init__(self, model: Gridworld, pi: set, backend="auto", evaluation="iterative",
+                 sweeps=5, linear_solver="direct") -> None:
         super().__init__(model)
+        self.check_backend(backend)
+        if evaluation not in ("iterative", "modified", "exact"):
+            raise Exception("Unsupported Evaluation")
+        self.backend = backend
+        self.evaluation = evaluation
+        self.sweeps = sweeps
+        self.linear_solver = linear_solver
         self._load_policy(pi)
 
     def _load_policy(self, pi: dict): 
@@ -85,90 +422,95 @@ class PolicyIteration(MDPSolver):
             
     def eval_upi(self, state: Tile) -> float:            
         return self.estimate_util(state, state.dir)
+
+    def sweep_policy(self):
+        mdl, states = self.model, self.mdp.states
+        new_util = self.mdp.policy_backup(mdl.util, mdl.dir[states])
+        delta = np.abs(mdl.util[states] - new_util).max(initial=0)
+        mdl.util[states] = new_util
+        return delta
+
+    def solve_policy(self, theta):
+        mdl, states = self.model, self.mdp.states
+        mdl.util[states] = self.mdp.solve_policy(mdl.util, mdl.dir[states], self.linear_solver, theta)
     
-    def policy_evaluation(self, theta, max_iter, display_result, display_mode):
+    def policy_evaluation(self, theta, max_iter):
+        if self.evaluation == "exact":
+            self.solve_policy(theta)
+            self.emit("evaluation", iteration=self.iterations, delta=None, backups=0)
+            return 0
+
+        if self.evaluation == "modified":
+            # a fixed number of sweeps per round, whatever the residual
+            theta, max_iter = 0, self.sweeps
+
         for _ in range(max_iter):
-            delta = 0
-            for state in self.get_states():
-                if state.is_walkable():
-                    new_util = self.eval_upi(state)
-                    delta = max(delta, abs(state.util - new_util))
-                    state.util = new_util
+            self.backups += self.states_count
+            if self.selected.arrays:
+                delta = self.sweep_policy()
+            else:
+                delta = 0
+                for state in self.get_states():
+                    if state.is_walkable():
+                        new_util = self.eval_upi(state)
+                        delta = max(delta, abs(state.util - new_util))
+                        state.util = new_util
                     
-            if display_result: 
-                self.clock.tick(8)
-                self.model.display(display_mode)
+            self.emit("evaluation", iteration=self.iterations, delta=float(delta), backups=self.states_count)
                 
             if delta < theta:
                 break
+        return delta
         
     def policy_improvement(self):
-        unchanged = True
+        self.backups += self.mdp.actions * self.states_count
+        changes = self.improve_arrays() if self.selected.arrays else self.improve_tiles()
+        self.emit("improvement", iteration=self.iterations, policy_changes=changes,
+                  backups=self.mdp.actions * self.states_count)
+        return changes == 0
+
+    def improve_tiles(self):
+        changes = 0
         for state in self.get_states():
             if state.is_walkable():
-                for action in range(4):
+                for action in range(self.mdp.actions):
                     expu = self.estimate_util(state, action)
                     state.set_aval(action, expu)
                 best_action, meu = self.arg_max(state)
 
                 piutil = state.aval[state.dir]
-                if best_action != state.dir and meu != piutil:
+                if meu - piutil > TIE * max(1, abs(piutil)):
                     state.dir = best_action
-                    unchanged = False
-        return unchanged
+                    changes += 1
+        return changes
+
+    def improve_arrays(self):
+        mdl, states = self.model, self.mdp.states
+        q = self.mdp.bellman(mdl.util)
+        policy = mdl.dir[states].astype(np.intp)
+        best = np.argmax(q, axis=0)
+        cols = np.arange(len(states))
+        current = q[policy, cols]
+        changed = q[best, cols] - current > TIE * np.maximum(1, np.abs(current))
+        mdl.q[:, states] = q
+        mdl.dir[states[changed]] = best[changed]
+        return int(np.count_nonzero(changed))
 
     def __call__(self, theta=0.0001, display_result=True, display_mode=DisplayMode.QVAL, max_iter=15):
-        for _ in range(max_iter):
-            self.policy_evaluation(theta, max_iter, display_result, display_mode)
-            unchanged = self.policy_improvement()
-            
-            if display_result: 
-                self.clock.tick(3)
-                self.model.display(display_mode)
+        with self.run(display_result, display_mode):
+            self.select_backend(theta)
+            self.compile()
+
+            for _ in range(max_iter):
+                self.iterations += 1
+                delta = self.policy_evaluation(theta, max_iter)
+                unchanged = self.policy_improvement()
                 
-            if unchanged:
-                break
+                # a truncated evaluation can leave the policy unchanged before the values settle
+                if unchanged and (self.evaluation != "modified" or delta < theta):
+                    break
             
 
 if __name__ == "__main__":
-    grid = Gridworld(6, 6, True)                    
-    grid.display(DisplayMode.UTILxDIR)
-
-    running = True
-    while running:
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                running = False
-
-            if event.type == pg.KEYDOWN:
-                if event.key == pg.K_ESCAPE:
-                    running = False
-
-                if event.key == pg.K_w: 
-                    grid.wipe()
-                    grid.display(DisplayMode.UTILxDIR)
-                
-                if event.key == pg.K_n: 
-                    grid = Gridworld(6, 6, True)
-                    grid.display(DisplayMode.UTILxDIR)
-                    
-        pressed = pg.key.get_pressed()
-        
-        if pressed[pg.K_v]: 
-            grid.wipe()
-            value_iter = ValueIteration(grid)
-            if pressed[pg.K_1]: 
-                value_iter(display_mode=DisplayMode.UTILxDIR)
-            elif pressed[pg.K_2]:
-                value_iter(display_mode=DisplayMode.QVAL)
-
-        if pressed[pg.K_p]: 
-            grid.wipe()
-            pi = {(i, j): "U" for i in range(grid.rows)
-                                for j in range(grid.cols)}
-            policy_iter = PolicyIteration(grid, pi)
-            
-            if pressed[pg.K_1]: 
-                policy_iter(display_mode=DisplayMode.UTILxDIR)
-            elif pressed[pg.K_2]:
-                policy_iter(display_mode=DisplayMode.QVAL)
+    from background import run_window
+    run_window(Gridworld(6, 6, True), new_grid=lambda: Gridworld(6, 6, True))
@@ -0,0 +1,150 @@
+from gridworld import Gridworld, DisplayMode, State
+from compiled import CompiledGrid
+from dynamics import Slip
+from optimalPolicy import MDPSolver
+from storage import Archive
+import numpy as np
+import math
+import os
+import tempfile
+from types import SimpleNamespace
+
+
+BYTES_PER_OUTCOME = 90  # peak working set of one tile cell per outcome: CSR tables, their copies, Bellman temporaries
+
+
+class TiledValueIteration(MDPSolver):
+    # Jacobi value iteration over a map stored in a storage archive, for maps larger than memory.
+    # Each sweep streams row-major tiles plus a halo of dynamics.reach cells through memory: the tile is mapped from
+    # the file, backed up into a scratch file and unmapped again, so the working set stays within
+    # memory_budget bytes whatever the size of the map. The values match ValueIteration(backend="numpy").
+    name = "value"
+
+    def __init__(self, path, index=0, memory_budget=256 << 20, scratch_dir=None, dynamics=None) -> None:
+        self.path = path
+        self.archive = Archive(path, mode="r")
+        header, self.arrays = self.archive.locate(index)
+        self.rows, self.cols = header["rows"], header["cols"]
+        super().__init__(Gridworld.from_arrays(self.rows, self.cols, None, None, None, None))
+        self.model.noise = header["noise"]
+        self.model.discount = header["discount"]
+        self.model.living_reward = header["living_reward"]
+        if dynamics is None:
+            # the archive's own, loading a record only maps it
+            dynamics = self.archive.load(index).dynamics or Slip()
+        self.dynamics = dynamics
+        if self.arrays["q"][2][0] != self.dynamics.actions:
+            raise Exception("Unsupported Dynamics")
+        self.scratch_dir = os.path.dirname(os.path.abspath(path)) if scratch_dir is None else scratch_dir
+        self.tile_rows, self.tile_cols = self.tile_shape(memory_budget)
+
+    def tile_shape(self, memory_budget):
+        # full-width stripes while three rows fit, square blocks beyond that
+        halo = 2 * self.dynamics.reach
+        cells = memory_budget // (BYTES_PER_OUTCOME * self.dynamics.actions * self.dynamics.branching)
+        if cells >= (halo + 1) * (self.cols + halo):
+            return min(cells // (self.cols + halo) - halo, self.rows), self.cols
+        side = math.isqrt(cells) - halo
+        if side < 1:
+            raise Exception("Memory budget too small")
+        return min(side, self.rows), min(side, self.cols)
+
+    def tiles(self):
+        for r0 in range(0, self.rows, self.tile_rows):
+            for c0 in range(0, self.cols, self.tile_cols):
+                yield r0, min(r0 + self.tile_rows, self.rows), c0, min(c0 + self.tile_cols, self.cols)
+
+    def view(self, name, r0, r1, path=None, plane=0, mode="r"):
+        # rows r0:r1 of one array, mapped only for as long as the view is alive
+        offset, dtype, _ = self.arrays[name]
+        if path is not None:
+            offset = 0
+        offset += (plane * self.rows + r0) * self.cols * dtype.itemsize
+        return np.memmap(path or self.path, dtype=dtype, mode=mode, offset=offset,
+                         shape=(r1 - r0, self.cols))
+
+    def count_states(self):
+        count = 0
+        for r0 in range(0, self.rows, self.tile_rows):
+            r1 = min(r0 + self.tile_rows, self.rows)
+            count += int(np.count_nonzero(self.view("codes", r0, r1) == State.WALKABLE.value))
+        return count
+
+    def load_tile(self, source, r0, r1, c0, c1):
+        # the tile and its halo as a small compiled grid, plus the positions of the tile's own states
+        reach = self.dynamics.reach
+        hr0, hr1 = max(r0 - reach, 0), min(r1 + reach, self.rows)
+        hc0, hc1 = max(c0 - reach, 0), min(c1 + reach, self.cols)
+        codes = np.array(self.view("codes", hr0, hr1)[:, hc0:hc1])
+        util = np.array(self.view("util", hr0, hr1, source)[:, hc0:hc1])
+        # a plain namespace rather than a Gridworld, whose tile map would keep every patch alive
+        # in a reference cycle until the next garbage collection
+        mdl = self.model
+        patch = SimpleNamespace(rows=hr1 - hr0, cols=hc1 - hc0, codes=codes.ravel(), util=util.ravel(),
+                                noise=mdl.noise, discount=mdl.discount, living_reward=mdl.living_reward)
+        mdp = CompiledGrid(patch, self.dynamics.crop(slice(hr0, hr1), slice(hc0, hc1), (self.rows, self.cols)))
+        rows, cols = np.divmod(mdp.states, mdp.cols)
+        inner = (rows >= r0 - hr0) & (rows < r1 - hr0) & (cols >= c0 - hc0) & (cols < c1 - hc0)
+        window = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+        return mdp, np.flatnonzero(inner), window
+
+    def sweep(self, source, target):
+        delta = 0
+        for r0, r1, c0, c1 in self.tiles():
+            mdp, positions, window = self.load_tile(source, r0, r1, c0, c1)
+            cells = mdp.states[positions]
+            new_util = mdp.bellman(mdp.util, positions).max(axis=0)
+            delta = max(delta, np.abs(mdp.util[cells] - new_util).max(initial=0))
+            mdp.util[cells] = new_util
+
+            out = self.view("util", r0, r1, target, mode="r+")
+            out[:, c0:c1] = mdp.util.reshape(mdp.rows, mdp.cols)[window]
+            out.flush()
+            del out
+        return delta
+
+    def extract(self, source):
+        # final pass: values, Q-values and greedy directions of source written into the archive
+        for r0, r1, c0, c1 in self.tiles():
+            mdp, positions, window = self.load_tile(source, r0, r1, c0, c1)
+            q = np.zeros((mdp.actions, mdp.n))
+            q[:, mdp.states[positions]] = mdp.bellman(mdp.util, positions)
+            dir = np.ones(mdp.n, dtype=np.int8)
+            dir[mdp.states[positions]] = np.argmax(q[:, mdp.states[positions]], axis=0)
+
+            for name, values in (("util", mdp.util), ("dir", dir)):
+                out = self.view(name, r0, r1, mode="r+")
+                out[:, c0:c1] = values.reshape(mdp.rows, mdp.cols)[window]
+                out.flush()
+            for action in range(mdp.actions):
+                out = self.view("q", r0, r1, plane=action, mode="r+")
+                out[:, c0:c1] = q[action].reshape(mdp.rows, mdp.cols)[window]
+                out.flush()
+            del out
+
+    def __call__(self, theta=0.0001, display_result=False, display_mode=DisplayMode.QVAL):
+        _, dtype, shape = self.arrays["util"]
+        with self.run(display_result, display_mode), tempfile.TemporaryDirectory(dir=self.scratch_dir) as scratch:
+            # Jacobi sweeps alternate between two scratch copies of the values
+            buffers = [os.path.join(scratch, "util0"), os.path.join(scratch, "util1")]
+            for buffer in buffers:
+                np.memmap(buffer, dtype=dtype, mode="w+", shape=shape).flush()
+            for r0 in range(0, self.rows, self.tile_rows):
+                r1 = min(r0 + self.tile_rows, self.rows)
+                out = self.view("util", r0, r1, buffers[0], mode="r+")
+                out[:] = self.view("util", r0, r1)
+                out.flush()
+                del out
+
+            source, target = buffers
+            while True:
+                delta = self.sweep(source, target)
+                source, target = target, source
+                self.iterations += 1
+                self.backups += self.dynamics.actions * self.states_count
+                self.emit("sweep", iteration=self.iterations, delta=float(delta),
+                          backups=self.dynamics.actions * self.states_count)
+                if delta < theta:
+                    break
+
+            self.extract(source)
@@ -0,0 +1,150 @@
+from multiprocessing import Barrier, Process
+from multiprocessing.shared_memory import SharedMemory
+from types import SimpleNamespace
+from gridworld import Gridworld, DisplayMode, State
+from compiled import CompiledGrid
+from dynamics import Slip
+from optimalPolicy import MDPSolver
+import numpy as np
+import os
+
+
+def partition(model: Gridworld, workers):
+    # row stripes holding about the same number of walkable cells each, at least one row per stripe
+    walkable = (model.codes == State.WALKABLE.value).reshape(model.rows, model.cols).sum(axis=1)
+    workers = max(1, min(workers, model.rows))
+    cumulative = np.cumsum(walkable)
+    bounds = [0]
+    for worker in range(1, workers):
+        row = int(np.searchsorted(cumulative, cumulative[-1] * worker / workers)) + 1
+        bounds.append(min(max(row, bounds[-1] + 1), model.rows - (workers - worker)))
+    bounds.append(model.rows)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class SharedArrays:
+    # named numpy arrays in one shared memory block, attached by name from the workers
+    def __init__(self, specs, name=None) -> None:
+        self.specs = specs
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in specs.values())
+        self.block = SharedMemory(name=name, create=name is None, size=max(size, 1) if name is None else 0)
+        self.arrays = {}
+        offset = 0
+        for key, (shape, dtype) in specs.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=offset)
+            self.arrays[key] = array
+            offset += array.nbytes
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+        self.block.close()
+
+
+def _worker(name, specs, stripe, shape, params, dynamics, barrier, worker):
+    # Owns rows r0:r1. Every sweep it reads its stripe plus a halo of dynamics.reach rows on each
+    # side from the source buffer, which the other workers finished writing before the barrier,
+    # and writes its own rows of the target buffer.
+    shared = SharedArrays(specs, name)
+    try:
+        rows, cols = shape
+        (r0, r1), util, control = stripe, shared["util"], shared["control"]
+        hr0, hr1 = max(r0 - dynamics.reach, 0), min(r1 + dynamics.reach, rows)
+        codes = shared["codes"][hr0 * cols:hr1 * cols]
+        mdp = CompiledGrid(SimpleNamespace(rows=hr1 - hr0, cols=cols, codes=codes, util=util[0, hr0 * cols:hr1 * cols],
+                                           **params), dynamics.crop(slice(hr0, hr1), slice(None), shape))
+        local_rows = mdp.states // cols
+        positions = np.flatnonzero((local_rows >= r0 - hr0) & (local_rows < r1 - hr0))  # the halo rows are read, never updated
+        cells = mdp.states[positions]
+        q = np.zeros((mdp.actions, len(positions)))
+
+        source = 0
+        while True:
+            barrier.wait()
+            if control[-1]:
+                break
+            patch = util[source, hr0 * cols:hr1 * cols]
+            q = mdp.bellman(patch, positions)
+            new_util = q.max(axis=0)
+            control[worker] = np.abs(patch[cells] - new_util).max(initial=0)
+            util[1 - source, hr0 * cols:hr1 * cols][cells] = new_util
+            source = 1 - source
+            barrier.wait()
+
+        shared["q"][:, hr0 * cols + cells] = q
+    except BaseException:
+        barrier.abort()  # wakes the parent instead of leaving it waiting for this worker
+        raise
+    finally:
+        shared.close()
+
+
+class ParallelValueIteration(MDPSolver):
+    # Jacobi value iteration split into row stripes over worker processes. Values, codes and the
+    # per-worker residuals live in shared memory; two barriers per sweep separate reading the halo
+    # rows from writing the next values, and the parent takes the max residual for the theta test.
+    name = "value"
+
+    def __init__(self, model: Gridworld, workers=None) -> None:
+        super().__init__(model)
+        self.workers = workers or os.cpu_count()
+        self.stripes = partition(model, self.workers)
+
+    def __call__(self, theta=0.0001, display_result=False, display_mode=DisplayMode.QVAL):
+        mdl = self.model
+        n, workers = mdl.rows * mdl.cols, len(self.stripes)
+        dynamics = mdl.dynamics or Slip()
+        specs = {"codes": ((n,), np.int8), "util": ((2, n), np.float64), "q": ((dynamics.actions, n), np.float64),
+                 "control": ((workers + 1,), np.float64)}
+        params = {"noise": mdl.noise, "discount": mdl.discount, "living_reward": mdl.living_reward}
+
+        with self.run(display_result, display_mode):
+            backups = dynamics.actions * self.states_count
+            shared = SharedArrays(specs)
+            barrier = Barrier(workers + 1)
+            processes = []
+            try:
+                shared["codes"][:] = mdl.codes
+                shared["util"][:] = mdl.util
+                shared["control"][:] = 0
+                processes = [Process(target=_worker, daemon=True,
+                                     args=(shared.block.name, specs, stripe, (mdl.rows, mdl.cols), params, dynamics,
+                                           barrier, worker))
+                             for worker, stripe in enumerate(self.stripes)]
+                for process in processes:
+                    process.start()
+
+                source = 0
+                while True:
+                    barrier.wait()  # workers read source, write target
+                    barrier.wait()  # every stripe is written
+                    source = 1 - source
+                    delta = shared["control"][:workers].max()
+                    self.iterations += 1
+                    self.backups += backups
+                    if self.syncs_model():
+                        mdl.util[:] = shared["util"][source]
+                    self.emit("sweep", iteration=self.iterations, delta=float(delta), backups=backups)
+                    if delta < theta:
+                        break
+
+                shared["control"][-1] = 1
+                barrier.wait()
+                for process in processes:
+                    process.join()
+                    if process.exitcode:
+                        raise Exception("Worker failed")
+
+                states = np.flatnonzero(mdl.codes == State.WALKABLE.value)
+                mdl.util[states] = shared["util"][source][states]
+                mdl.set_actions(dynamics.actions)
+                mdl.q[:, states] = shared["q"][:, states]
+                mdl.dir[states] = np.argmax(mdl.q[:, states], axis=0)
+            finally:
+                barrier.abort()
+                for process in processes:
+                    process.join()
+                shared.close()
+                shared.block.unlink()
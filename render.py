@@ -0,0 +1,304 @@
+from collections import OrderedDict
+from gridworld import Gridworld, DisplayMode, State, Tile, STATE_COLORS
+from dynamics import MOVES8
+from settings import *
+import numpy as np
+import math
+
+
+class LabelCache:
+    # fonts per size and rendered text surfaces, least recently used labels are evicted first
+    def __init__(self, maxsize=4096) -> None:
+        self.maxsize = maxsize
+        self.fonts = {}
+        self.labels = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            import pygame as pg
+            font = self.fonts[size] = pg.font.SysFont("Arials", size)
+        return font
+
+    def render(self, text, size, color):
+        key = (text, size, color)
+        img = self.labels.get(key)
+        if img is not None:
+            self.hits += 1
+            self.labels.move_to_end(key)
+            return img
+
+        self.misses += 1
+        img = self.font(size).render(text, True, color)
+        self.labels[key] = img
+        if len(self.labels) > self.maxsize:
+            self.labels.popitem(last=False)
+        return img
+
+    def clear(self):
+        self.labels.clear()
+        self.hits = self.misses = 0
+
+
+LABELS = LabelCache()
+
+
+class Renderer:
+    # redraws only the tiles whose state, utility, direction or Q-values changed since the last frame
+    def __init__(self, model: Gridworld) -> None:
+        self.model = model
+        self.mode = None
+        self.last = None
+        self.dirty = 0
+
+    def invalidate(self):
+        self.last = None
+
+    def handle(self, event):
+        # the tile view has no viewport to move
+        return False
+
+    def changed_tiles(self, mode):
+        mdl = self.model
+        if self.last is None or mode != self.mode or self.last[3].shape != mdl.q.shape:
+            return None
+        codes, util, dir, q = self.last
+        changed = (mdl.codes != codes) | (mdl.util != util) | (mdl.dir != dir) | (mdl.q != q).any(axis=0)
+        return np.flatnonzero(changed)
+
+    def draw_tile(self, tile: Tile, mode):
+        # clipped to the tile so that a redraw never leaves strokes from a neighbour behind
+        mdl = self.model
+        mdl.screen.set_clip(tile.rect)
+        tile.draw(mdl.screen, mode)
+        if tile.is_walkable():
+            if mode == DisplayMode.QVAL:
+                mdl.draw_Q_values(tile)
+            elif mode == DisplayMode.UTILxDIR:
+                mdl.draw_V_values(tile)
+        mdl.screen.set_clip(None)
+
+    def draw(self, mode):
+        import pygame as pg
+        mdl = self.model
+        changed = self.changed_tiles(mode)
+
+        if changed is None:
+            mdl.screen.fill(BLACK)
+            for tile in mdl.grid.values():
+                self.draw_tile(tile, mode)
+            pg.display.flip()
+            self.dirty = len(mdl.grid)
+        else:
+            rects = []
+            for index in changed.tolist():
+                tile = Tile(mdl, *divmod(index, mdl.cols))
+                rect = tile.rect
+                mdl.screen.fill(BLACK, rect)
+                self.draw_tile(tile, mode)
+                rects.append(rect)
+            if rects:
+                pg.display.update(rects)
+            self.dirty = len(rects)
+
+        self.mode = mode
+        self.last = (mdl.codes.copy(), mdl.util.copy(), mdl.dir.copy(), mdl.q.copy())
+
+
+DETAIL_CELL = 40  # pixels per cell from which the heatmap adds the tile labels and direction markers
+MAX_CELL = 4 * TILESIZE
+PALETTE = np.zeros((max(state.value for state in State) + 1, 3), dtype=np.uint8)
+for state, color in STATE_COLORS.items():
+    PALETTE[state.value] = color
+
+
+def heat_colors(values):
+    # Triangle._update_color over an array: green scaled by positive values, red by negative ones,
+    # saturated beyond 1
+    values = np.asarray(values, dtype=np.float64)
+    ends = np.array((RED, GREEN), dtype=np.float64)[(values >= 0).view(np.int8)]
+    ends *= np.minimum(np.abs(values), 1)[..., None]
+    return np.ceil(ends, out=ends).astype(np.uint8)
+
+
+def sectors(cell, actions):
+    # the action whose direction each pixel of a cell x cell block lies closest to: the four
+    # triangles of Tile.triangles, eight wedges with the diagonal actions
+    offsets = np.arange(cell) + 0.5 - cell / 2
+    directions = np.array([(dc, dr) for dr, dc in MOVES8[:actions]], dtype=np.float64)
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    y, x = np.meshgrid(offsets, offsets, indexing="ij")
+    return np.argmax(x[..., None] * directions[:, 0] + y[..., None] * directions[:, 1], axis=-1)
+
+
+class HeatmapRenderer:
+    # Large-map view: every visible cell is one block of pixels written into a surface array,
+    # coloured like the tile triangles (Q-values split into one wedge per action when a block is big
+    # enough, utilities otherwise). scale is in pixels per cell and below 1 shows every stride-th
+    # cell; top/left is the cell at the window corner. Tile labels and markers are only drawn once
+    # blocks reach DETAIL_CELL pixels. Mouse wheel or +/- zoom, dragging or the arrows pan, HOME fits.
+    def __init__(self, model: Gridworld) -> None:
+        self.model = model
+        self.scale = None
+        self.top = self.left = 0.0
+        self.dirty = 0
+        self._sectors = {}
+
+    def invalidate(self):
+        pass  # every frame is drawn in full, the array writes cost less than finding changed cells
+
+    def block(self):
+        # pixels per drawn block and cells per block side, the view never shows more than scale asks
+        return max(int(self.scale), 1), max(math.ceil(1 / self.scale), 1)
+
+    def fit(self):
+        mdl = self.model
+        width, height = mdl.screen.get_size()
+        self.scale = min(width / mdl.cols, height / mdl.rows)
+        cell, stride = self.block()
+        self.top = (mdl.rows - height / cell * stride) / 2
+        self.left = (mdl.cols - width / cell * stride) / 2
+
+    def zoom(self, factor, anchor=None):
+        mdl = self.model
+        width, height = mdl.screen.get_size()
+        x, y = (width / 2, height / 2) if anchor is None else anchor
+        cell, stride = self.block()
+        row, col = self.top + y / cell * stride, self.left + x / cell * stride
+        lowest = min(width / mdl.cols, height / mdl.rows) / 2
+        self.scale = min(max(self.scale * factor, lowest), MAX_CELL)
+        cell, stride = self.block()
+        self.top, self.left = row - y / cell * stride, col - x / cell * stride
+
+    def pan(self, dx, dy):
+        # by screen pixels, an edge of the map stops at the middle of the window
+        mdl = self.model
+        width, height = mdl.screen.get_size()
+        cell, stride = self.block()
+        half_cols, half_rows = width / cell * stride / 2, height / cell * stride / 2
+        self.left = min(max(self.left + dx / cell * stride, -half_cols), mdl.cols - half_cols)
+        self.top = min(max(self.top + dy / cell * stride, -half_rows), mdl.rows - half_rows)
+
+    def handle(self, event):
+        # True when the event moved the view
+        import pygame as pg
+        width, height = self.model.screen.get_size()
+        if event.type == pg.MOUSEWHEEL:
+            self.zoom(1.25 ** event.y, pg.mouse.get_pos())
+        elif event.type == pg.MOUSEMOTION and event.buttons[0]:
+            self.pan(-event.rel[0], -event.rel[1])
+        elif event.type == pg.KEYDOWN and event.key in (pg.K_PLUS, pg.K_EQUALS, pg.K_KP_PLUS):
+            self.zoom(2)
+        elif event.type == pg.KEYDOWN and event.key in (pg.K_MINUS, pg.K_KP_MINUS):
+            self.zoom(0.5)
+        elif event.type == pg.KEYDOWN and event.key == pg.K_HOME:
+            self.fit()
+        elif event.type == pg.KEYDOWN and event.key in (pg.K_LEFT, pg.K_RIGHT, pg.K_UP, pg.K_DOWN):
+            step = {pg.K_LEFT: (-width // 8, 0), pg.K_RIGHT: (width // 8, 0),
+                    pg.K_UP: (0, -height // 8), pg.K_DOWN: (0, height // 8)}[event.key]
+            self.pan(*step)
+        else:
+            return False
+        return True
+
+    def visible(self, start, count, extent, cell, stride):
+        # the slice of one axis inside the window, every stride-th cell, and the pixel of its first
+        first = max(math.floor(start / stride) * stride, 0)
+        last = max(min(math.ceil(start + extent / cell * stride), count), first)
+        return slice(first, last, stride), round((first - start) / stride * cell)
+
+    def colors(self, mode, rows, cols, cell):
+        # RGB of the visible cells, (actions, rows, cols, 3) when Q-values are split into wedges;
+        # the visible cells are strided views of the (rows, cols) arrays, nothing is gathered
+        mdl = self.model
+        codes = mdl.codes.reshape(mdl.rows, mdl.cols)[rows, cols]
+        walkable = codes == State.WALKABLE.value
+        if mode == DisplayMode.QVAL and cell >= 3:
+            colors = np.repeat(np.take(PALETTE, codes, axis=0)[None], len(mdl.q), axis=0)
+            colors[:, walkable] = heat_colors(mdl.q.reshape(-1, mdl.rows, mdl.cols)[:, rows, cols][:, walkable])
+        else:
+            colors = np.take(PALETTE, codes, axis=0)
+            colors[walkable] = heat_colors(mdl.util.reshape(mdl.rows, mdl.cols)[rows, cols][walkable])
+        return colors
+
+    def pixels_pattern(self, cell, actions):
+        pattern = self._sectors.get((cell, actions))
+        if pattern is None:
+            pattern = self._sectors[(cell, actions)] = sectors(cell, actions)
+        return pattern
+
+    def pixels(self, colors, cell):
+        # one cell x cell block per cell, dark lines between cells once blocks are large
+        if colors.ndim == 4:
+            pattern = self.pixels_pattern(cell, len(colors))
+            rows, cols = colors.shape[1:3]
+            flat = pattern[None, :, None, :] * (rows * cols) + (np.arange(rows)[:, None, None, None] * cols
+                                                                + np.arange(cols)[None, None, :, None])
+            image = np.take(colors.reshape(-1, 3), flat, axis=0)
+        else:
+            rows, cols = colors.shape[:2]
+            image = np.broadcast_to(colors[:, None, :, None], (rows, cell, cols, cell, 3)).copy()
+        if cell >= 4:
+            image[:, 0] = image[:, :, :, 0] = 0
+        return image.reshape(rows * cell, cols * cell, 3)
+
+    def draw(self, mode):
+        import pygame as pg
+        mdl = self.model
+        if self.scale is None:
+            self.fit()
+        width, height = mdl.screen.get_size()
+        cell, stride = self.block()
+        rows, y = self.visible(self.top, mdl.rows, height, cell, stride)
+        cols, x = self.visible(self.left, mdl.cols, width, cell, stride)
+
+        mdl.screen.fill(BLACK)
+        count = len(range(mdl.rows)[rows]) * len(range(mdl.cols)[cols])
+        if count:
+            image = self.pixels(self.colors(mode, rows, cols, cell), cell)
+            surface = pg.Surface(image.shape[1::-1])
+            pg.surfarray.blit_array(surface, image.swapaxes(0, 1))
+            mdl.screen.blit(surface, (x, y))
+            if cell >= DETAIL_CELL:
+                cells = np.arange(mdl.rows * mdl.cols).reshape(mdl.rows, mdl.cols)[rows, cols]
+                self.draw_details(mode, cells, cell, x, y)
+        pg.display.flip()
+        self.dirty = count
+
+    def draw_details(self, mode, cells, cell, x0, y0):
+        # the labels, direction markers and outlines of the tile view, at this zoom
+        import pygame as pg
+        mdl = self.model
+        screen = mdl.screen
+        actions = len(mdl.q)
+        if mode == DisplayMode.QVAL:
+            # labels at the centroid of each action's wedge
+            pattern = self.pixels_pattern(cell, actions)
+            centers = [np.argwhere(pattern == action).mean(axis=0)[::-1] for action in range(actions)]
+        label_size = cell // 5 if actions == 4 else cell // 7
+        for (i, j), index in np.ndenumerate(cells):
+            x, y = x0 + j * cell, y0 + i * cell
+            rect = pg.Rect(x, y, cell, cell)
+            pg.draw.rect(screen, WHITE, rect, 2)
+            if mdl.codes[index] != State.WALKABLE.value:
+                if mdl.codes[index] != State.WALL.value:
+                    img = LABELS.render('%.2f' % mdl.util[index], cell // 4, WHITE)
+                    screen.blit(img, img.get_rect(center=rect.center))
+                continue
+            if mode == DisplayMode.QVAL:
+                if actions == 4:
+                    pg.draw.line(screen, WHITE, rect.topleft, rect.bottomright, 2)
+                    pg.draw.line(screen, WHITE, rect.topright, rect.bottomleft, 2)
+                for action, (cx, cy) in enumerate(centers):
+                    img = LABELS.render('%.2f' % mdl.q[action, index], label_size, WHITE)
+                    screen.blit(img, img.get_rect(center=(x + cx, y + cy)))
+            else:
+                img = LABELS.render('%.2f' % mdl.util[index], cell // 4, WHITE)
+                screen.blit(img, img.get_rect(center=rect.center))
+                dr, dc = MOVES8[mdl.dir[index]]
+                marker = pg.Rect(0, 0, cell // 10, cell // 10)
+                reach = cell / 2 - 2 * cell // 20
+                marker.center = rect.centerx + dc * reach, rect.centery + dr * reach
+                pg.draw.rect(screen, WHITE, marker)
@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from gridworld import Gridworld
+from compiled import CompiledGrid
+import numpy as np
+
+
+class RolloutEngine:
+    # simulates many episodes of a fixed policy at once, one array slot per episode
+    def __init__(self, model: Gridworld, policy=None) -> None:
+        self.mdp = CompiledGrid(model)
+        self.policy = (model.dir if policy is None else np.asarray(policy).ravel()).astype(np.intp)
+
+    def simulate(self, starts, rng, max_steps=10000):
+        mdp = self.mdp
+        state = np.array(starts, dtype=np.intp)
+        returns = np.zeros(len(state))
+        discount = np.ones(len(state))
+        lengths = np.zeros(len(state), dtype=np.int64)
+        # a wall or off-map start would read another state's row
+        if ((state < 0) | (state >= mdp.n)).any() or mdp.walls[state % mdp.n].any():
+            raise Exception("Unsupported State")
+
+        # episodes that start on a terminal are worth its utility straight away
+        alive = ~mdp.terminal[state]
+        returns[~alive] = mdp.util[state[~alive]]
+
+        for _ in range(max_steps):
+            episodes = np.flatnonzero(alive)
+            if not episodes.size:
+                break
+            current = state[episodes]
+            action = self.policy[current]
+            nxt = mdp.sample(current, action, rng.random(len(episodes)))
+
+            returns[episodes] += discount[episodes] * mdp.living_reward
+            discount[episodes] *= mdp.discount
+            lengths[episodes] += 1
+            state[episodes] = nxt
+
+            done = episodes[mdp.terminal[nxt]]
+            returns[done] += discount[done] * mdp.util[state[done]]
+            alive[done] = False
+
+        return returns, lengths, alive
+
+
+def _simulate_chunk(engine, starts, seed, max_steps):
+    return engine.simulate(starts, np.random.default_rng(seed), max_steps)
+
+
+def evaluate_policy(model: Gridworld, starts=None, episodes=1000, workers=1, seed=None,
+                    max_steps=10000, policy=None):
+    # Monte Carlo estimate of the discounted return from every (row, col) in starts,
+    # defaults to every walkable tile and to the policy currently stored in model.dir
+    engine = RolloutEngine(model, policy)
+    if starts is None:
+        cells = engine.mdp.states
+    else:
+        cells = np.array([row * model.cols + col for row, col in starts], dtype=np.intp)
+    all_starts = np.repeat(cells, episodes)
+
+    # one independent random stream per worker chunk
+    chunks = np.array_split(all_starts, workers)
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    if workers == 1:
+        parts = [_simulate_chunk(engine, chunks[0], seeds[0], max_steps)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            parts = list(pool.map(_simulate_chunk, repeat(engine), chunks, seeds, repeat(max_steps)))
+
+    returns = np.concatenate([part[0] for part in parts]).reshape(len(cells), episodes)
+    lengths = np.concatenate([part[1] for part in parts])
+    truncated = np.concatenate([part[2] for part in parts])
+
+    std = returns.std(axis=1, ddof=1) if episodes > 1 else np.zeros(len(cells))
+    return {
+        "starts": [divmod(int(cell), model.cols) for cell in cells],
+        "mean": returns.mean(axis=1),
+        "ci": 1.96 * std / np.sqrt(episodes),  # 95% normal interval half-width
+        "lengths": np.bincount(lengths),
+        "truncated": int(truncated.sum()),
+    }
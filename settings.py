@@ -1,8 +1,8 @@
-import pygame
 TILESIZE = 120
 TITLE = "Gridworld Display"
-BLACK = pygame.Color(0, 0, 0)
-WHITE = pygame.Color(255, 255, 255)
-GREEN = pygame.Color(0, 220, 0)
-RED = pygame.Color(220, 0, 0)
-LIGHTGREY = pygame.Color(100, 100, 100)
+WINDOW = (1200, 900)  # largest window, maps whose tiles do not fit are shown as a heatmap
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+GREEN = (0, 220, 0)
+RED = (220, 0, 0)
+LIGHTGREY = (100, 100, 100)
@@ -0,0 +1,170 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from gridworld import Gridworld
+from optimalPolicy import ValueIteration, PolicyIteration
+from backends import BACKENDS
+from dynamics import Slip, KingMoves
+from generator import MapGenerator
+import storage
+import argparse
+import json
+import numpy as np
+import os
+import sys
+import time
+
+
+# Headless batch solver: python solve.py maps.gw more.npy --generate 1000 --size 50 50 --seed 7
+# prints one JSON line per map, in input order, as soon as the map and those before it are solved.
+# Never imports pygame, so it starts in the time it takes to import NumPy.
+
+DYNAMICS = {"slip": Slip, "king": KingMoves}
+
+_worker_options = None
+
+
+def jobs(paths, generate=0, start=0):
+    # (source, kind, path, index) of every map: each record of a storage archive, each (rows, cols)
+    # layer of a .npy array of State codes, then the generated maps start..start+generate-1
+    for path in paths:
+        if path.endswith(".npy"):
+            codes = np.load(path, mmap_mode="r")
+            if codes.ndim == 2:
+                yield (path, "array", path, None)
+            elif codes.ndim == 3:
+                for index in range(len(codes)):
+                    yield (f"{path}#{index}", "array", path, index)
+            else:
+                raise Exception("Unsupported Map Array")
+        else:
+            for index in range(len(storage.Archive(path, "r"))):
+                yield (f"{path}#{index}", "archive", path, index)
+    for index in range(start, start + generate):
+        yield (f"generated#{index}", "generated", None, index)
+
+
+def load_map(kind, path, index, options):
+    if kind == "archive":
+        model = storage.load(path, index)
+    elif kind == "array":
+        codes = np.load(path, mmap_mode="r")
+        codes = codes if index is None else codes[index]
+        model = Gridworld(*codes.shape, codes=codes)
+    elif kind == "generated":
+        generator = MapGenerator(*options["size"], options["goal_ratio"], options["wall_ratio"], options["seed"])
+        model = Gridworld(*options["size"], codes=generator.generate(index)[0])
+    else:
+        raise Exception("Unsupported Map Source")
+    model.wipe()
+    for name in ("discount", "noise", "living_reward"):
+        if options[name] is not None:
+            setattr(model, name, options[name])
+    if options["dynamics"] is not None:
+        model.dynamics = DYNAMICS[options["dynamics"]]()
+    return model
+
+
+def solve_map(job, options):
+    # one JSONL record: the solve statistics and, unless options["arrays"] is off, the (rows, cols)
+    # values and policy. A map that fails gives a record with its error instead.
+    source, kind, path, index = job
+    start = time.perf_counter()
+    try:
+        model = load_map(kind, path, index, options)
+        if options["solver"] == "value":
+            solver = ValueIteration(model, backend=options["backend"])
+            solver(theta=options["theta"], display_result=False)
+        else:
+            solver = PolicyIteration(model, {}, backend=options["backend"])
+            solver(theta=options["theta"], display_result=False, max_iter=options["max_iter"])
+    except Exception as error:
+        return {"source": source, "error": str(error)}
+
+    record = {"source": source, "rows": model.rows, "cols": model.cols, "solver": options["solver"],
+              "backend": solver.selected.name, "discount": model.discount, "noise": model.noise,
+              "living_reward": model.living_reward, "theta": options["theta"],
+              "iterations": solver.iterations, "backups": solver.backups, "solve_seconds": solver.runtime,
+              "seconds": time.perf_counter() - start}
+    if options["arrays"]:
+        shape = (model.rows, model.cols)
+        record["values"] = model.util.reshape(shape).tolist()
+        record["policy"] = model.dir.reshape(shape).tolist()
+    return record
+
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+
+
+def _solve_job(job):
+    return solve_map(job, _worker_options)
+
+
+def solve_all(jobs, options, workers=None, chunk=1):
+    # records in job order, streamed: each is yielded once it and every job before it are done
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        yield from map(solve_map, jobs, repeat(options))
+        return
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(options,))
+    try:
+        yield from pool.map(_solve_job, jobs, chunksize=chunk)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Solve gridworld maps headlessly, one JSON line per map")
+    parser.add_argument("maps", nargs="*", help="storage archives (every record) or .npy arrays of State codes")
+    parser.add_argument("--generate", type=int, default=0, help="also solve this many generated maps")
+    parser.add_argument("--start", type=int, default=0, help="index of the first generated map")
+    parser.add_argument("--size", type=int, nargs=2, default=[25, 25], metavar=("ROWS", "COLS"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--goal-ratio", type=float, default=10)
+    parser.add_argument("--wall-ratio", type=float, default=20)
+    parser.add_argument("--solver", choices=["value", "policy"], default="value")
+    parser.add_argument("--backend", choices=["auto", *BACKENDS], default="auto")
+    parser.add_argument("--dynamics", choices=list(DYNAMICS), help="default: the map's own (the four-way slip)")
+    parser.add_argument("--discount", type=float, help="default: the map's own")
+    parser.add_argument("--noise", type=float, help="default: the map's own")
+    parser.add_argument("--living-reward", type=float, help="default: the map's own")
+    parser.add_argument("--theta", type=float, default=0.0001)
+    parser.add_argument("--max-iter", type=int, default=15, help="policy iteration rounds")
+    parser.add_argument("--no-arrays", dest="arrays", action="store_false",
+                        help="leave the values and policy out of the records")
+    parser.add_argument("--workers", type=int, help="worker processes, default one per CPU")
+    parser.add_argument("--chunk", type=int, default=1, help="maps sent to a worker at a time")
+    args = parser.parse_args(argv)
+
+    if not args.maps and not args.generate:
+        parser.error("give map files or --generate")
+    if args.backend != "auto" and not BACKENDS[args.backend].available():
+        parser.error(f"the {args.backend} backend requires {BACKENDS[args.backend].requires}")
+    options = {name: getattr(args, name) for name in
+               ("size", "seed", "goal_ratio", "wall_ratio", "solver", "backend", "dynamics", "discount",
+                "noise", "living_reward", "theta", "max_iter", "arrays")}
+
+    try:
+        queue = list(jobs(args.maps, args.generate, args.start))  # unreadable inputs fail before any output
+    except Exception as error:
+        parser.error(str(error))
+
+    failed = 0
+    records = solve_all(queue, options, args.workers, args.chunk)
+    try:
+        for record in records:
+            failed += "error" in record
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader went away (| head): drop the maps still queued and keep the exit quiet
+        records.close()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    if failed:
+        sys.exit(f"{failed} map(s) failed")
+
+
+if __name__ == "__main__":
+    main()
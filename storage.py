@@ -0,0 +1,211 @@
+from gridworld import Gridworld, State
+from dynamics import from_spec
+import json
+import numpy as np
+import struct
+
+
+# File layout, all offsets in bytes from the start of the file:
+#   MAGIC, uint32 version
+#   records: RECORD, uint64 header length, JSON header, then the codes/util/dir/q arrays from
+#            the next ALIGN boundary on, each padded to a multiple of ALIGN
+#   footer:  JSON index of the records, uint64 index offset, INDEX
+# A record's JSON header holds rows, cols, noise, discount, living_reward, the dynamics spec (None
+# for the default four-way Slip, per-cell values stored as extra arrays), the caller's meta and,
+# for every array, its dtype, shape and offset into the record's data, so a record can be
+# memory-mapped in place.
+
+MAGIC = b"GRIDMDP\0"
+RECORD = b"REC\0"
+INDEX = b"GRIDIDX\0"
+VERSION = 1
+ALIGN = 64
+ARRAYS = ("codes", "util", "dir", "q")
+
+
+def _padding(offset):
+    return -offset % ALIGN
+
+
+class ArchiveWriter:
+    # Appends solved maps one at a time, memory use does not grow with the number of maps.
+    # The index is written by close(); an archive whose writer never closed is still readable.
+    def __init__(self, path) -> None:
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<I", VERSION))
+        self.index = []
+
+    def _write_record(self, rows, cols, params, meta, arrays):
+        # arrays maps each name in ARRAYS to (dtype, shape, iterable of chunks in file order)
+        offset = self.file.tell()
+        header = {"rows": rows, "cols": cols, **params, "meta": meta, "arrays": {}}
+        position = 0
+        for name, (dtype, shape, _) in arrays.items():
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            header["arrays"][name] = {"dtype": np.dtype(dtype).str, "shape": list(shape),
+                                      "offset": position}
+            position += nbytes + _padding(nbytes)
+        header["nbytes"] = position
+
+        encoded = json.dumps(header).encode()
+        self.file.write(RECORD + struct.pack("<Q", len(encoded)) + encoded)
+        self.file.write(b"\0" * _padding(self.file.tell()))
+        for name, (dtype, shape, chunks) in arrays.items():
+            nbytes = 0
+            for chunk in chunks:
+                chunk = np.ascontiguousarray(chunk, dtype=dtype)
+                self.file.write(memoryview(chunk).cast("B"))
+                nbytes += chunk.nbytes
+            self.file.write(b"\0" * _padding(nbytes))
+        self.index.append({"offset": offset, "rows": rows, "cols": cols, "meta": meta})
+        return len(self.index) - 1
+
+    def write(self, model: Gridworld, **meta):
+        extra = {}
+        dynamics = None if model.dynamics is None else model.dynamics.spec(extra)
+        params = {"noise": model.noise, "discount": model.discount, "living_reward": model.living_reward,
+                  "dynamics": dynamics}
+        arrays = {}
+        for name in ARRAYS:
+            array = getattr(model, name)
+            arrays[name] = (array.dtype, array.shape, (array,))
+        for name, array in extra.items():
+            arrays[name] = (array.dtype, array.shape, (array,))
+        return self._write_record(model.rows, model.cols, params, meta, arrays)
+
+    def write_layout(self, codes, rows, cols, noise=0.2, discount=.9, living_reward=0, chunk=1 << 20, actions=4,
+                     **meta):
+        # Writes an unsolved map straight from its state codes, chunk cells at a time, so maps far
+        # larger than memory can be created for the out-of-core solver. codes may be a memmap,
+        # actions the number of Q-value planes the dynamics it will be solved with need.
+        codes = np.asarray(codes).reshape(-1)
+        n = rows * cols
+        starts = range(0, n, chunk)
+
+        def utils():
+            for start in starts:
+                part = codes[start:start+chunk]
+                yield (part == State.DIAMOND.value).astype(np.float64) - (part == State.PIT.value)
+
+        params = {"noise": noise, "discount": discount, "living_reward": living_reward}
+        arrays = {
+            "codes": (np.int8, (n,), (codes[start:start+chunk] for start in starts)),
+            "util": (np.float64, (n,), utils()),
+            "dir": (np.int8, (n,), (np.ones(min(chunk, n - start), np.int8) for start in starts)),
+            "q": (np.float64, (actions, n), (np.zeros(min(chunk, n - start)) for _ in range(actions) for start in starts)),
+        }
+        return self._write_record(rows, cols, params, meta, arrays)
+
+    def close(self):
+        if self.file.closed:
+            return
+        offset = self.file.tell()
+        self.file.write(json.dumps(self.index).encode() + struct.pack("<Q", offset) + INDEX)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Archive:
+    # Opens an archive memory-mapped: opening and loading a map are O(1), pages are only read when
+    # an array is touched. mode "c" (copy-on-write) lets solvers run on a loaded map without
+    # changing the file, "r" is read-only and "r+" writes changes through to the file.
+    def __init__(self, path, mode="c") -> None:
+        self.buffer = np.memmap(path, dtype=np.uint8, mode=mode)
+        if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+            raise Exception("Unsupported File")
+        version, = struct.unpack("<I", bytes(self.buffer[len(MAGIC):len(MAGIC)+4]))
+        if version != VERSION:
+            raise Exception("Unsupported Format Version")
+        self.offsets = self._read_index()
+
+    def _read_index(self):
+        buffer = self.buffer
+        if len(buffer) >= 16 and bytes(buffer[-len(INDEX):]) == INDEX:
+            offset, = struct.unpack("<Q", bytes(buffer[-16:-8]))
+            return [entry["offset"] for entry in json.loads(bytes(buffer[offset:-16]))]
+
+        # no footer, the writer did not finish: walk the records instead
+        offsets, offset = [], len(MAGIC) + 4
+        while bytes(buffer[offset:offset+len(RECORD)]) == RECORD:
+            header, data = self._header(offset)
+            if data + header["nbytes"] > len(buffer):
+                break
+            offsets.append(offset)
+            offset = data + header["nbytes"]
+        return offsets
+
+    def _header(self, offset):
+        # the record's JSON header and where its array data starts
+        start = offset + len(RECORD)
+        length, = struct.unpack("<Q", bytes(self.buffer[start:start+8]))
+        end = start + 8 + length
+        return json.loads(bytes(self.buffer[start+8:end])), end + _padding(end)
+
+    def _array(self, data, spec):
+        start = data + spec["offset"]
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        return self.buffer[start:start + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return self.load(index)
+
+    def __iter__(self):
+        return (self.load(index) for index in range(len(self)))
+
+    def locate(self, index=0):
+        # rows, cols, MDP parameters and {name: (absolute offset, dtype, shape)} of a record,
+        # for readers that map parts of the file themselves
+        header, data = self._header(self.offsets[index])
+        arrays = {name: (data + spec["offset"], np.dtype(spec["dtype"]), tuple(spec["shape"]))
+                  for name, spec in header.pop("arrays").items()}
+        return header, arrays
+
+    def meta(self, index):
+        return self._header(self.offsets[index])[0]["meta"]
+
+    def load(self, index=0):
+        header, data = self._header(self.offsets[index])
+        arrays = [self._array(data, header["arrays"][name]) for name in ARRAYS]
+        model = Gridworld.from_arrays(header["rows"], header["cols"], *arrays)
+        model.noise = header["noise"]
+        model.discount = header["discount"]
+        model.living_reward = header["living_reward"]
+        model.dynamics = from_spec(header.get("dynamics"), {name: self._array(data, spec)
+                                                            for name, spec in header["arrays"].items()})
+        return model
+
+    def region(self, index, rows, cols):
+        # copies the rows x cols window (a pair of slices) into a standalone Gridworld,
+        # only the pages under the window are read
+        model = self.load(index)
+        shape = (model.rows, model.cols)
+        codes = model.codes.reshape(shape)[rows, cols]
+        window = Gridworld(*codes.shape, codes=codes)
+        window.util[:] = model.util.reshape(shape)[rows, cols].ravel()
+        window.dir[:] = model.dir.reshape(shape)[rows, cols].ravel()
+        window.set_actions(len(model.q))
+        window.q[:] = model.q.reshape((-1, *shape))[:, rows, cols].reshape(len(model.q), -1)
+        window.noise = model.noise
+        window.discount = model.discount
+        window.living_reward = model.living_reward
+        if model.dynamics is not None:
+            window.dynamics = model.dynamics.crop(rows, cols, shape)
+        return window
+
+
+def save(model: Gridworld, path, **meta):
+    with ArchiveWriter(path) as writer:
+        writer.write(model, **meta)
+
+
+def load(path, index=0, mode="c"):
+    return Archive(path, mode).load(index)
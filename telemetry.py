@@ -0,0 +1,51 @@
+from gridworld import Gridworld, DisplayMode
+import json
+
+
+# Solvers call every subscribed hook with one event dict per sweep:
+#   solver, phase ("sweep" | "evaluation" | "improvement"), iteration, delta, backups,
+#   elapsed (seconds since the solve started), duration (seconds since the previous event)
+# and policy_changes for "improvement" events.
+
+
+class Trace(list):
+    # keeps every event in memory
+    def __call__(self, event):
+        self.append(event)
+
+    def column(self, field):
+        return [event.get(field) for event in self]
+
+
+class JsonlSink:
+    # appends one JSON line per event to a file
+    def __init__(self, path, mode="a") -> None:
+        self.file = open(path, mode)
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DisplaySink:
+    # redraws the gridworld after every event, paced like the original solver loops
+    needs_model = True
+    FPS = {"sweep": 4, "evaluation": 8, "improvement": 3}
+
+    def __init__(self, model: Gridworld, mode=DisplayMode.QVAL) -> None:
+        import pygame as pg
+        self.model = model
+        self.mode = mode
+        self.clock = pg.time.Clock()
+
+    def __call__(self, event):
+        self.clock.tick(self.FPS.get(event["phase"], 4))
+        self.model.display(self.mode)
@@ -1,11 +1,43 @@
 import settings; settings.TILESIZE = 30 
-from gridworld import Gridworld, DisplayMode
+from gridworld import Gridworld, DisplayMode, State, Triangle
 from optimalPolicy import ValueIteration, PolicyIteration
-from random import randint
-import pygame 
+from rollout import evaluate_policy
+from render import LABELS
+from background import run_window
+from cache import SolutionCache
+from outofcore import TiledValueIteration
+from env import VectorEnv
+from dynamics import Slip, KingMoves, Wind
+from incremental import PrioritizedSweeping
+from generator import MapGenerator
+from backends import available
+import storage
+import numpy as np
+from random import randint, random
+import tracemalloc
+import os
 import time 
 
 
+class ObjectTile: 
+    # per-cell footprint of the former dict-of-Tile grid, only used by Test.memory
+    def __init__(self, row, col):
+        import pygame
+        self.row = row
+        self.col = col
+        self.state = State.WALKABLE
+        self.x = (col+.2) * settings.TILESIZE
+        self.y = (row+.2) * settings.TILESIZE
+        self.rect = pygame.Rect(self.x, self.y, settings.TILESIZE, settings.TILESIZE)
+        self.color = pygame.Color(*settings.BLACK)
+        center = (self.x + settings.TILESIZE/2, self.y + settings.TILESIZE/2)
+        self.triangles = tuple(Triangle(pygame.Color(*settings.BLACK), ((self.x, self.y), (self.x, self.y), center))
+                               for _ in range(4))
+        self.util = 0.00
+        self.dir = 1
+        self.aval = {0: 0, 1: 0, 2: 0, 3: 0}
+
+
 class Test: 
     def __init__(self):
         self.model = Gridworld(25, 25, random=True, wall_ratio=25)
@@ -21,97 +53,298 @@ class Test:
             pi[coor] = state.dir 
         return pi 
     
-    def runtime(self, n=3): 
-        res = {"Value": 0, "Policy": 0}
-        value_iter = ValueIteration(self.model)     
-        pi = {(i, j): 1 for i in range(self.model.rows)
-                        for j in range(self.model.cols)}
-        policy_iter = PolicyIteration(self.model, pi) 
-
-        print("Initiating runtime test...")
-        for i in range(n):    
-            self.model.wipe()    
-            start = time.time()               
-            value_iter(display_result=False, theta=0.0001)
-            res["Value"] += time.time() - start
+    def memory(self, sizes=(10, 50, 100, 250, 500)): 
+        print("Initiating memory test...")
+        ObjectTile(0, 0)  # imports pygame outside the measured windows
+        for size in sizes: 
+            tracemalloc.start()
+            start = time.time()
+            model = Gridworld(size, size)
+            arrays_time = time.time() - start
+            arrays = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del model
             
-            self.model.wipe()
-            policy_iter._load_policy(pi)
+            tracemalloc.start()
             start = time.time()
-            policy_iter(display_result=False, theta=0.0001)
-            res["Policy"] += time.time() - start
+            grid = {(i, j): ObjectTile(i, j) for i in range(size) for j in range(size)}
+            objects_time = time.time() - start
+            objects = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del grid
             
-        res = {i: j/n for i, j in res.items()}
-        print("average:", res)
+            print(f"{size}x{size}: arrays {arrays/2**20:.2f} MiB in {arrays_time:.3f}s,",
+                  f"objects {objects/2**20:.2f} MiB in {objects_time:.3f}s ({objects/arrays:.0f}x)")
         
-    def robot_runner(self, state, pi): 
-        reward, steps, current_state = 0, 0, state
-        commit = self.model.commit
-        while True:
-            steps += 1
-            if current_state.is_pit() or current_state.is_diamond():
-                break
+    def spawn_walls_full_check(self, model, percent): 
+        # the former generator, one full connectivity DFS per candidate wall
+        desired_walls = int((model.rows * model.cols) * (percent / 100))
+        placed_walls = 0
+        while True: 
+            for tile in model.grid.values():
+                if placed_walls >= desired_walls:
+                    return
+                if randint(1, 100) < percent and tile.is_walkable():
+                    if model.add_wall_safely(tile):
+                        placed_walls += 1
+
+    def generation(self, sizes=(25, 50, 100, 200, 400), wall_ratio=25, full_check_limit=50): 
+        print("Initiating generation test...")
+        for size in sizes: 
+            model = Gridworld(size, size)
+            model.spawn_terminals(10)
+            start = time.time()
+            model.spawn_walls(wall_ratio)
+            incremental = time.time() - start
+            line = f"{size}x{size}: incremental {incremental:.3f}s"
             
-            action = pi[current_state.get_state_coor()]
-            rand = randint(1, 100)
-            if rand <= (1 - self.model.noise) * 100: 
-                current_state = commit(current_state, action)
-            elif (1 - self.model.noise) * 100 < rand <= (1 - self.model.noise/2) * 100: 
-                current_state = commit(current_state, (action-1)%4)
-            else: 
-                current_state = commit(current_state, (action+1)%4)
+            if size <= full_check_limit: 
+                model = Gridworld(size, size)
+                model.spawn_terminals(10)
+                start = time.time()
+                self.spawn_walls_full_check(model, wall_ratio)
+                line += f", full check {time.time() - start:.3f}s"
+            print(line)
+        
+    def dataset(self, sizes=(25, 50, 100), count=200, wall_ratio=25, seed=0, workers=None): 
+        print("Initiating dataset generation test...")
+        for size in sizes: 
+            line = f"{size}x{size}:"
+            for search in (True, False): 
+                generator = MapGenerator(size, size, wall_ratio=wall_ratio, seed=seed, search=search)
+                maps = generator.batch(count, workers=workers)
+                line += f" {generator.maps_per_second:.1f} maps/s (search={search}, {generator.missing_walls} walls short)"
+            same = np.array_equal(maps[count//2:], generator.batch(count - count//2, start=count//2, workers=1))
+            print(line + f", reproducible: {same}")
+
+    def sweep_schemes(self, backend="numpy", omegas=(1.0, 1.1), theta=0.0001): 
+        print("Initiating sweep scheme test...")
+        for sweep in ("jacobi", "gauss-seidel", "ordered"): 
+            for omega in omegas: 
+                self.model.wipe()
+                value_iter = ValueIteration(self.model, backend=backend, sweep=sweep, omega=omega)
+                value_iter(display_result=False, theta=theta)
+                print(f"{sweep} (omega={omega}): {value_iter.iterations} sweeps in {value_iter.runtime:.4f}s")
+        
+    def bounds(self, backend="numpy", discount=0.95, theta=0.0001): 
+        print("Initiating stopping rule and action elimination test...")
+        model = self.model.copy()
+        model.discount = discount
+        model.wipe()
+        baseline = ValueIteration(model, backend=backend)
+        baseline(display_result=False, theta=theta)
+        for options in ({"stopping": "span"}, {"stopping": "epsilon"}, {"eliminate": True},
+                        {"stopping": "span", "eliminate": True}): 
+            model.wipe()
+            value_iter = ValueIteration(model, backend=backend, **options)
+            value_iter(display_result=False, theta=theta)
+            print(f"{options}: {value_iter.iterations} sweeps ({baseline.iterations - value_iter.iterations} saved,",
+                  f"{value_iter.sweeps_saved} estimated), {value_iter.backups} backups,",
+                  f"{value_iter.skipped_backups} skipped, policy loss <= {value_iter.loss_bound:.2e},",
+                  f"{value_iter.runtime:.4f}s ({baseline.runtime:.4f}s)")
+
+    def multigrid(self, sizes=(100, 300), discount=0.99, goal_ratio=0.05, wall_ratio=10, theta=0.0001): 
+        print("Initiating multigrid test...")
+        for size in sizes: 
+            model = Gridworld(size, size, True, goal_ratio, wall_ratio)
+            model.discount = discount
+            cold = ValueIteration(model, backend="numpy")
+            cold(display_result=False, theta=theta)
+            model.wipe()
+            warm = ValueIteration(model, backend="numpy", multigrid=True)
+            warm(display_result=False, theta=theta)
+            print(f"{size}x{size}: {cold.iterations} -> {warm.iterations} fine sweeps",
+                  f"(coarse levels {warm.coarse_sweeps}), {cold.runtime:.3f}s -> {warm.runtime:.3f}s")
+
+    def out_of_core(self, size=500, memory_budget=8 << 20, path="out_of_core.gw", theta=0.0001): 
+        print("Initiating out-of-core test...")
+        model = Gridworld(size, size, True)
+        storage.save(model, path)
+        in_memory = ValueIteration(model, backend="numpy")
+        in_memory(display_result=False, theta=theta)
+        tiled = TiledValueIteration(path, memory_budget=memory_budget)
+        tiled(theta=theta)
+        solved = storage.load(path)
+        print(f"{size}x{size} in {tiled.tile_rows}x{tiled.tile_cols} tiles: {tiled.iterations} sweeps in",
+              f"{tiled.runtime:.3f}s ({in_memory.runtime:.3f}s in memory),",
+              f"max difference {np.abs(solved.util - model.util).max():.2e}")
+        del solved
+        os.remove(path)
+
+    def fps(self, sizes=(25, 50, 100), frames=30, changed=50, mode=DisplayMode.QVAL): 
+        print("Initiating frame rate test...")
+        for size in sizes: 
+            model = Gridworld(size, size, random=True, wall_ratio=25)
+            model.view = "tiles"
+            ValueIteration(model, backend="numpy")(display_result=False)
+            model.display(mode)
+            walkable = np.flatnonzero(model.codes == State.WALKABLE.value)
             
-            reward += self.model.living_reward
+            start = time.time()
+            for _ in range(frames): 
+                model.renderer.invalidate()
+                model.display(mode)
+            full = frames / (time.time() - start)
             
-        return reward + self.model.discount ** (steps - 1) * current_state.util 
+            # a few utilities move per frame, as near the end of a solve
+            start = time.time()
+            for _ in range(frames): 
+                model.util[np.random.choice(walkable, min(changed, len(walkable)), replace=False)] += 0.001
+                model.display(mode)
+            dirty = frames / (time.time() - start)
+            print(f"{size}x{size}: full redraw {full:.1f} fps, {changed} changed tiles {dirty:.1f} fps",
+                  f"(label cache {LABELS.hits} hits / {LABELS.misses} misses)")
+            
+    def heatmap(self, sizes=(500, 2000), frames=30, zooms=(1, 4, 32), mode=DisplayMode.QVAL): 
+        print("Initiating heatmap test...")
+        for size in sizes: 
+            model = Gridworld(size, size, random=True, wall_ratio=25, seed=0)
+            model.view = "heatmap"
+            ValueIteration(model)(display_result=False)
+            model.display(mode)
+            for zoom in zooms: 
+                model.renderer.fit()
+                model.renderer.zoom(zoom)
+                start = time.time()
+                for _ in range(frames): 
+                    model.display(mode)
+                rate = frames / (time.time() - start)
+                cell, stride = model.renderer.block()
+                print(f"{size}x{size} at {cell}px per {stride} cell(s): {model.renderer.dirty} cells drawn, {rate:.1f} fps")
+
+    def cache(self, noises=(0.2, 0.22, 0.25, 0.2), backend="numpy", theta=0.0001): 
+        print("Initiating solution cache test...")
+        cache = SolutionCache()
+        for noise in noises: 
+            self.model.noise = noise
+            self.model.wipe()
+            cold = ValueIteration(self.model, backend=backend)
+            cold(display_result=False, theta=theta)
+
+            warm = cache.solve(self.model, lambda model: ValueIteration(model, backend=backend),
+                               theta=theta, display_result=False)
+            sweeps = 0 if warm is None else warm.iterations
+            print(f"noise={noise}: {cold.iterations} sweeps cold, {sweeps} with the cache")
+        self.model.noise = 0.2
+        print(cache.stats())
+
+    def env_steps(self, agents=100000, steps=100, commit_steps=100000, seed=0): 
+        print("Initiating environment step test...")
+        mdl = self.model
+        noise = mdl.noise
+        tile = mdl.get_random_tile()
+        start = time.perf_counter()
+        for _ in range(commit_steps): 
+            action, rand = randint(0, 3), random()
+            if rand >= 1 - noise: 
+                action = (action-1) % 4 if rand < 1 - noise/2 else (action+1) % 4
+            tile = mdl.commit(tile, action)
+            if not tile.is_walkable(): 
+                tile = mdl.get_random_tile()
+        commit_rate = commit_steps / (time.perf_counter() - start)
+
+        env = VectorEnv(mdl, agents, seed)
+        states = env.reset()
+        start = time.perf_counter()
+        for _ in range(steps): 
+            states, rewards, dones = env.step(states, env.rng.integers(env.mdp.actions, size=agents))
+        env_rate = agents * steps / (time.perf_counter() - start)
+        print(f"commit: {commit_rate:.3g} steps/s, VectorEnv ({agents} agents): {env_rate:.3g} steps/s",
+              f"({env_rate / commit_rate:.0f}x)")
+
+    def dynamics(self, theta=0.0001): 
+        print("Initiating dynamics test...")
+        for dynamics in (None, KingMoves(), Wind(strength=0.2), Wind(KingMoves(), strength=0.2)): 
+            model = self.model.copy()
+            model.dynamics = dynamics
+            model.wipe()
+            value_iter = ValueIteration(model, backend="numpy")
+            value_iter(display_result=False, theta=theta)
+            exact = PolicyIteration(model, {}, backend="numpy", evaluation="exact")
+            exact(display_result=False, theta=theta)
+            print(f"{(dynamics or Slip()).key()}: {value_iter.mdp.transitions.indptr[-1]} transitions, {value_iter.iterations} sweeps in",
+                  f"{value_iter.runtime:.4f}s, {exact.iterations} policy iterations in {exact.runtime:.4f}s")
 
-    def robot(self, k=1000): 
+    def incremental(self, edits=10, theta=0.0001): 
+        # a chain of edits, each re-solved from the last: residuals below the solve threshold and values
+        # within theta of a full solve, both solving to within theta / 2 of the optimal values
+        print("Initiating incremental re-solve test...")
+        model = self.model.copy()
+        tight = theta * (1 - model.discount) / 2
+        ValueIteration(model, backend="numpy")(display_result=False, theta=tight)
+        for _ in range(edits): 
+            tile = model.get_random_tile()
+            if random() < 0.5: 
+                model.set_wall(tile.row, tile.col)
+            else: 
+                (model.set_diamond if random() < 0.5 else model.set_pit)(tile.row, tile.col)
+            resolve = PrioritizedSweeping(model)
+            resolve(theta=tight)
+            result = resolve.compare(tight)
+            print(f"({tile.row}, {tile.col}) -> {tile.state.name}: {resolve.updates} state backups over",
+                  f"{resolve.touched} states, {result['backups']} backups vs {result['full_backups']} full",
+                  f"({result['ratio']:.2%}), residual {result['residual']:.2e},",
+                  f"max difference {result['max_difference']:.2e}")
+            if result["residual"] >= tight or result["max_difference"] > theta: 
+                raise Exception("Incremental re-solve missed the fixed point")
+
+    def backends(self, theta=0.0001): 
+        # every available backend against the first one, on the same solves: values within theta,
+        # and a different action only where its Q-value is within theta of the best. Backends may
+        # sweep in different orders, so each solves to within theta / 2 of the optimal values.
+        print("Initiating backend conformance test...")
+        names = available()
+        discount = self.model.discount
+        tight = theta * (1 - discount) / (2 * discount) if discount < 1 else theta / 2
+        solves = ((ValueIteration, {"sweep": "jacobi"}, {}), (ValueIteration, {"sweep": "gauss-seidel"}, {}),
+                  (PolicyIteration, {"evaluation": "iterative"}, {"max_iter": 1000}),
+                  (PolicyIteration, {"evaluation": "exact"}, {"max_iter": 1000}))
+        for dynamics in (None, KingMoves()): 
+            for solver, options, call in solves: 
+                reference = None
+                for name in names: 
+                    model = self.model.copy()
+                    model.dynamics = dynamics
+                    model.wipe()
+                    args = (model,) if solver is ValueIteration else (model, {})
+                    solver(*args, backend=name, **options)(display_result=False, theta=tight, **call)
+                    if reference is None: 
+                        reference = model
+                        continue
+                    cells = np.flatnonzero(model.codes == State.WALKABLE.value)
+                    value_error = np.abs(model.util - reference.util).max(initial=0)
+                    policy_error = (reference.q[:, cells].max(axis=0) - reference.q[model.dir[cells], cells]).max(initial=0)
+                    print(f"{(dynamics or Slip()).key()} {solver.__name__} {options}: {name} vs {names[0]}",
+                          f"value {value_error:.2e}, policy {policy_error:.2e}")
+                    if value_error > theta or policy_error > theta: 
+                        raise Exception("Backends disagree")
+
+    def robot(self, k=1000, workers=1, seed=None): 
         self.optimal_policy = self.extract_policy()
         state = self.model.get_random_tile()
-        total_reward = 0 
-        for _ in range(k): 
-            total_reward += self.robot_runner(state, self.optimal_policy)
-        total_reward /= k 
-        print(f"({state.row}, {state.col}):", total_reward)
+        result = evaluate_policy(self.model, [state.get_state_coor()], episodes=k, workers=workers, seed=seed)
+        print(f"({state.row}, {state.col}): {result['mean'][0]:.4f} +/- {result['ci'][0]:.4f}",
+              f"(utility {state.util:.4f}, {result['truncated']} truncated)")
     
                     
-test = Test()
-test.runtime()
+if __name__ == "__main__":
+    test = Test()
 
-# test.robot()
+    # test.robot()
+    # test.memory()
+    # test.generation()
+    # test.dataset()
+    # test.sweep_schemes()
+    # test.fps()
+    # test.heatmap()
+    # test.multigrid()
+    # test.bounds()
+    # test.out_of_core()
+    # test.env_steps()
+    # test.cache()
+    # test.dynamics()
+    # test.incremental()
+    # test.backends()
 
 
-test.model.display(DisplayMode.UTILxDIR)
-running = True
-while running: 
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT: 
-            running = False
-            
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                running = False
-            if event.key == pygame.K_w: 
-                test.model.wipe()
-                test.model.display(DisplayMode.UTILxDIR)
-    
-    pressed = pygame.key.get_pressed()
-        
-    if pressed[pygame.K_v]: 
-        test.model.wipe()
-        value_iter = ValueIteration(test.model)
-        if pressed[pygame.K_1]: 
-            value_iter(display_mode=DisplayMode.UTILxDIR)
-        elif pressed[pygame.K_2]:
-            value_iter(display_mode=DisplayMode.QVAL)
-
-    if pressed[pygame.K_p]: 
-        test.model.wipe()
-        pi = {(i, j): 1 for i in range(test.model.rows)
-                            for j in range(test.model.cols)}
-        policy_iter = PolicyIteration(test.model, pi)
-        
-        if pressed[pygame.K_1]: 
-            policy_iter(display_mode=DisplayMode.UTILxDIR)
-        elif pressed[pygame.K_2]:
-            policy_iter(display_mode=DisplayMode.QVAL)
+    run_window(test.model)